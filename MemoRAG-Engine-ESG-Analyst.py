@@ -7,39 +7,278 @@ Resolves Chroma query syntax issues
 
 import chromadb
 from sentence_transformers import SentenceTransformer
-import pandas as pd
+import torch
 import numpy as np
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable
 import json
 import re
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
 import pickle
 import os
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import asyncio
+import functools
+import contextlib
+import atexit
+import weakref
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+def _json_dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """Serialize to UTF-8 JSON bytes (orjson when available)"""
+    if ORJSON_AVAILABLE:
+        # Non-str keys and NumPy values are accepted, as the json fallback (keys) and default hooks already allow
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON bytes (orjson when available)"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _is_valid_value(value: Any) -> bool:
+    """Whether an extracted value is usable (non-empty, non-NaN)"""
+    if not value:
+        return False
+    text = str(value)
+    return text.lower() != 'nan' and bool(text.strip())
+
+# Metadata fields repeated across many records (company names, codes, ...)
+_INTERNED_METADATA_FIELDS = ('company', 'field_code', 'field_name', 'ticker')
+
+def _intern_metadata(metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Intern repeated string metadata values in place so duplicates share one object"""
+    if metadata:
+        for key in _INTERNED_METADATA_FIELDS:
+            value = metadata.get(key)
+            if type(value) is str:
+                metadata[key] = sys.intern(value)
+    return metadata
+
+def _min_max(values) -> tuple:
+    """(min, max) of a non-empty iterable in a single pass"""
+    it = iter(values)
+    lo = hi = next(it)
+    for value in it:
+        if value < lo:
+            lo = value
+        elif value > hi:
+            hi = value
+    return lo, hi
+
+def _aggregate_rows(valid: np.ndarray, years: np.ndarray) -> tuple:
+    """Count valid rows and fold the year range (years < 0 are missing)"""
+    present = years[years >= 0]
+    if present.size == 0:
+        return int(valid.sum()), -1, -1
+    return int(valid.sum()), int(present.min()), int(present.max())
+
+if NUMBA_AVAILABLE:
+    # Numeric columns only; the text path stays in Python
+    _aggregate_rows = njit(_aggregate_rows)
+
+@functools.lru_cache(maxsize=4)
+def _load_model(model_name: str, device: str = "cpu", half_precision: bool = False) -> SentenceTransformer:
+    """Load an embedding model once per process (shared by all FixedMemoRAG instances)"""
+    model = SentenceTransformer(model_name, device=device)
+    if half_precision:
+        if device.startswith('cuda'):
+            model = model.half()  # fp16 on tensor cores
+        else:
+            model = model.to(torch.bfloat16)  # bf16 on AVX-512 BF16 / AMX CPUs
+    return model
+
+@contextlib.contextmanager
+def _matmul_precision(precision: Optional[str]):
+    """Temporarily set torch's float32 matmul precision (process-wide), restoring it afterwards"""
+    if precision is None:
+        yield
+        return
+    previous = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision(precision)
+    try:
+        yield
+    finally:
+        torch.set_float32_matmul_precision(previous)
+
+# Distinct (language, retrieved results + context) scopes kept by LLMResponseGenerator
+_RESPONSE_CACHE_SCOPES = 256
+
+class SemanticResponseCache:
+    """Semantic response cache (near-duplicate queries matched by embedding centroid)"""
+    
+    def __init__(self, threshold: float = 0.86, capacity: int = 512):
+        """Initialize cache"""
+        self.threshold = threshold
+        self.capacity = capacity
+        self.centroids = None  # (N, D) float32, L2-normalized
+        self.responses = []
+    
+    def lookup(self, vector: np.ndarray) -> Optional[str]:
+        """Return cached response for the closest centroid above threshold"""
+        if self.centroids is None:
+            return None
+        
+        similarities = self.centroids @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return self.responses[best]
+        return None
+    
+    def add(self, vector: np.ndarray, response: str):
+        """Store a response for a query embedding"""
+        if self.centroids is None:
+            self.centroids = vector[np.newaxis, :]
+        else:
+            self.centroids = np.vstack([self.centroids, vector])
+        self.responses.append(response)
+        
+        if len(self.responses) > self.capacity:
+            self._compact()
+    
+    def _compact(self):
+        """Merge near-duplicate entries into centroids, then drop the oldest if still full"""
+        sums, responses = [], []
+        centroids = np.empty((0, self.centroids.shape[1]), dtype=np.float32)
+        
+        for vector, response in zip(self.centroids, self.responses):
+            if len(responses):
+                similarities = centroids @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    sums[best] += vector
+                    centroids[best] = sums[best] / np.linalg.norm(sums[best])
+                    responses[best] = response  # Keep the most recent answer
+                    continue
+            sums.append(vector.copy())
+            centroids = np.vstack([centroids, vector])
+            responses.append(response)
+        
+        # Leave headroom so the next few inserts don't trigger another compaction
+        keep = min(len(responses), self.capacity * 3 // 4)
+        self.centroids = centroids[-keep:]
+        self.responses = responses[-keep:]
+
+# Static prompt text for LLMResponseGenerator._build_prompt
+_PROMPT_INTRO = """You are a professional ESG data analyst. Please generate a professional, accurate, and understandable response based on the following query and data.
+
+Query: """
+_PROMPT_SUMMARY_HEADER = """
+
+Data Summary (sorted by quality, ✅ indicates valid data, ❌ indicates missing data):
+"""
+_PROMPT_CONTEXT_LABEL = """
+
+Context: """
+_PROMPT_INSTRUCTIONS = """
+
+Important Notes:
+- Prioritize using ✅ valid data for analysis
+- For ❌ missing data, clearly explain the data gaps
+- If valid data is insufficient, explain analysis limitations
+
+Please generate a response that includes the following elements:
+1. Direct answer to user's question (based on valid data)
+2. Analysis of data trends and patterns (focus on valid data)
+3. Provide professional insights
+4. Clearly explain data gaps and reasons
+5. Give recommendations or conclusions
+
+Response Requirements:
+- Use """
+_PROMPT_REQUIREMENTS = """
+- Professional but understandable
+- Based on valid data facts
+- Clearly distinguish between valid and missing data
+- Clear structure
+- Appropriate length (200-400 words)
+
+Response:"""
 
 class LLMResponseGenerator:
     """LLM Response Generator"""
     
-    def __init__(self, api_key: str = None):
-        """Initialize LLM Response Generator"""
+    def __init__(self, api_key: str = None, encoder=None):
+        """Initialize LLM Response Generator
+        
+        Args:
+            api_key: DeepSeek API key
+            encoder: Optional callable mapping a list of texts to embeddings; enables the semantic response cache
+                (opt-in: a hit also requires the same retrieved results and context)
+        """
         self.api_key = api_key
         self.base_url = "https://api.deepseek.com/v1/chat/completions"
         self.language = "en"  # Default to English
         
+        # Semantic response caches, one per (language, retrieved results + context) scope, LRU-bounded
+        self.encoder = encoder
+        self._response_caches = OrderedDict()
+        
+        # Persistent session: keep-alive connection pool, retries honour Retry-After
+        retry = Retry(
+            total=3,
+            backoff_factor=2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            raise_on_status=False
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry))
+        
     def generate_response(self, query: str, results: List[Dict], context: str = "") -> str:
         """Generate intelligent response"""
         try:
             if not self.api_key:
                 return self._fallback_response(query, results)
             
+            # Reuse the answer of a near-duplicate query over the same retrieved data
+            query_vector = self._embed_query(query)
+            scope = self._cache_scope(results, context)
+            cached = self._lookup_cached_response(query_vector, scope)
+            if cached is not None:
+                return cached
+            
             # Build prompt
             prompt = self._build_prompt(query, results, context)
             
-            # Call API (with retry mechanism)
-            response = self._call_api_with_retry(prompt)
+            # Call API (retries handled by the session adapter)
+            response = self._call_api(prompt)
             
+            self._cache_response(query_vector, scope, response)
             return response
             
         except Exception as e:
@@ -47,86 +286,140 @@ class LLMResponseGenerator:
             print("🔄 Switching to basic response mode...")
             return self._fallback_response(query, results)
     
-    def _call_api_with_retry(self, prompt: str, max_retries: int = 3) -> str:
-        """API call with retry mechanism"""
+    def _embed_query(self, query: str) -> Optional[np.ndarray]:
+        """Embed a query for the semantic cache (None when no encoder is configured)"""
+        if self.encoder is None:
+            return None
+        
+        vector = np.asarray(self.encoder([query]), dtype=np.float32)[0]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def _cache_scope(self, results: List[Dict], context: str) -> tuple:
+        """Cache scope: response language plus a fingerprint of the retrieved documents and context"""
+        documents = tuple(result.get('document') for result in results)
+        return self.language, hash((documents, context))
+    
+    def _lookup_cached_response(self, query_vector: Optional[np.ndarray], scope: tuple) -> Optional[str]:
+        """Look up a cached response answered from the same retrieved results and context"""
+        if query_vector is None or scope not in self._response_caches:
+            return None
+        self._response_caches.move_to_end(scope)
+        return self._response_caches[scope].lookup(query_vector)
+    
+    def _cache_response(self, query_vector: Optional[np.ndarray], scope: tuple, response: str):
+        """Cache a response under its scope"""
+        if query_vector is None:
+            return
+        caches = self._response_caches
+        if scope not in caches:
+            caches[scope] = SemanticResponseCache()
+            while len(caches) > _RESPONSE_CACHE_SCOPES:
+                caches.popitem(last=False)
+        caches[scope].add(query_vector, response)
+    
+    def generate_batch(self, items: List[tuple]) -> List[str]:
+        """Generate responses for multiple (query, results, context) items concurrently
+        
+        Inside a running event loop (Jupyter, async callers) this falls back to sequential
+        calls; await agenerate_batch there instead.
+        """
+        if not self.api_key:
+            return [self._fallback_response(query, results) for query, results, _ in items]
+        
+        if HTTPX_AVAILABLE:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return asyncio.run(self.agenerate_batch(items))
+        
+        # Without httpx or inside a running loop, fall back to sequential synchronous calls
+        return [self.generate_response(query, results, context) for query, results, context in items]
+    
+    async def agenerate_batch(self, items: List[tuple]) -> List[str]:
+        """Generate responses for multiple (query, results, context) items on one async client"""
+        if not self.api_key:
+            return [self._fallback_response(query, results) for query, results, _ in items]
+        
+        if not HTTPX_AVAILABLE:
+            # Without httpx, run the synchronous calls off the event loop one by one
+            return [await asyncio.to_thread(self.generate_response, query, results, context)
+                    for query, results, context in items]
+        
+        # Serve near-duplicate queries from the cache, send only the misses
+        vectors = [self._embed_query(query) for query, _, _ in items]
+        scopes = [self._cache_scope(results, context) for _, results, context in items]
+        outputs = [self._lookup_cached_response(vector, scope) for vector, scope in zip(vectors, scopes)]
+        pending = [i for i, output in enumerate(outputs) if output is None]
+        
+        if pending:
+            prompts = [self._build_prompt(*items[i]) for i in pending]
+            responses = await self._call_api_batch_async(prompts)
+            
+            for i, response in zip(pending, responses):
+                query, results, _ = items[i]
+                if isinstance(response, Exception):
+                    print(f"LLM call failed: {str(response)}")
+                    print("🔄 Switching to basic response mode...")
+                    outputs[i] = self._fallback_response(query, results)
+                else:
+                    self._cache_response(vectors[i], scopes[i], response)
+                    outputs[i] = response
+        
+        return outputs
+    
+    async def _call_api_batch_async(self, prompts: List[str]) -> List[Any]:
+        """Submit all prompts on a shared keep-alive client, then await them together"""
+        limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+            return await asyncio.gather(
+                *[self._call_api_async_with_retry(client, prompt) for prompt in prompts],
+                return_exceptions=True
+            )
+    
+    async def _call_api_async_with_retry(self, client, prompt: str, max_retries: int = 3) -> str:
+        """Async API call with retry mechanism"""
         for attempt in range(max_retries):
             try:
-                return self._call_api(prompt)
+                return await self._call_api_async(client, prompt)
             except Exception as e:
                 if attempt < max_retries - 1:
                     print(f"🔄 API call failed, retrying {attempt + 1}/{max_retries}: {str(e)}")
-                    time.sleep(2)  # Wait 2 seconds before retry
+                    await asyncio.sleep(2)  # Wait 2 seconds before retry
                 else:
                     raise e
     
     def _build_prompt(self, query: str, results: List[Dict], context: str) -> str:
         """Build prompt"""
-        # Extract key data
-        companies = list(set([r['esg_info'].get('company', '') for r in results if r['esg_info'].get('company')]))
-        years = list(set([r['esg_info'].get('year', '') for r in results if r['esg_info'].get('year')]))
-        indicators = list(set([r['esg_info'].get('indicator', '') for r in results if r['esg_info'].get('indicator')]))
-        
-        # Build data summary (prioritize valid data)
-        data_summary = []
-        valid_data_count = 0
-        
-        for i, r in enumerate(results[:10], 1):  # Show more data for LLM analysis
-            esg_info = r['esg_info']
-            value = esg_info.get('value', 'N/A')
-            rerank_score = r.get('rerank_score', 0)
-            
-            # Mark data quality
-            if value and str(value).lower() != 'nan' and str(value).strip():
-                data_quality = "✅Valid data"
-                valid_data_count += 1
-            else:
-                data_quality = "❌Missing data"
-            
-            data_summary.append(f"{i}. {data_quality} {esg_info.get('company', 'N/A')} ({esg_info.get('year', 'N/A')}) - {esg_info.get('indicator', 'N/A')}: {value} [Quality score:{rerank_score:.1f}]")
+        shown = self._columnize(results[:10])  # Show more data for LLM analysis
         
-        # Add data quality statistics
-        data_summary.append(f"\nData quality statistics: {valid_data_count} valid data, {len(results) - valid_data_count} missing data")
+        # Mark data quality for all shown rows at once
+        valid_mask = self._valid_mask(shown['valid'])
+        valid_data_count, _, _ = _aggregate_rows(valid_mask, self._year_array(shown['year']))
+        quality_labels = np.where(valid_mask, "✅Valid data", "❌Missing data")
         
         # Determine response language based on language setting
         response_language = "English"
         if self.language == 'zh':
             response_language = "Chinese (中文)"
         
-        prompt = f"""You are a professional ESG data analyst. Please generate a professional, accurate, and understandable response based on the following query and data.
-
-Query: {query}
-
-Data Summary (sorted by quality, ✅ indicates valid data, ❌ indicates missing data):
-{chr(10).join(data_summary)}
-
-Context: {context}
-
-Important Notes:
-- Prioritize using ✅ valid data for analysis
-- For ❌ missing data, clearly explain the data gaps
-- If valid data is insufficient, explain analysis limitations
-
-Please generate a response that includes the following elements:
-1. Direct answer to user's question (based on valid data)
-2. Analysis of data trends and patterns (focus on valid data)
-3. Provide professional insights
-4. Clearly explain data gaps and reasons
-5. Give recommendations or conclusions
-
-Response Requirements:
-- Use {response_language}
-- Professional but understandable
-- Based on valid data facts
-- Clearly distinguish between valid and missing data
-- Clear structure
-- Appropriate length (200-400 words)
-
-Response:"""
+        # Static template text is module-level; only dynamic pieces are formatted, then joined once
+        parts = [_PROMPT_INTRO, query, _PROMPT_SUMMARY_HEADER]
+        
+        # Build data summary (prioritize valid data)
+        rows = zip(shown['company'], shown['year'], shown['indicator'], shown['value'],
+                   shown['rerank_score'], quality_labels)
+        for i, (company, year, indicator, value, rerank_score, data_quality) in enumerate(rows, 1):
+            parts.append(f"{i}. {data_quality} {self._or_na(company)} ({self._or_na(year)}) - {self._or_na(indicator)}: {self._or_na(value)} [Quality score:{rerank_score:.1f}]\n")
+        
+        # Add data quality statistics
+        parts.append(f"\nData quality statistics: {valid_data_count} valid data, {len(results) - valid_data_count} missing data")
         
-        return prompt
+        parts.extend((_PROMPT_CONTEXT_LABEL, context, _PROMPT_INSTRUCTIONS, response_language, _PROMPT_REQUIREMENTS))
+        return "".join(parts)
     
-    def _call_api(self, prompt: str) -> str:
-        """Call API"""
+    def _build_request(self, prompt: str) -> tuple:
+        """Build request headers and payload"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -141,11 +434,51 @@ Response:"""
             "temperature": 0.7
         }
         
+        return headers, data
+    
+    @staticmethod
+    def _columnize(results: List[Dict]) -> Dict[str, List]:
+        """Unpack result rows into per-field columns (None where a field is missing)"""
+        columns = {'company': [], 'year': [], 'indicator': [], 'value': [], 'valid': [], 'rerank_score': []}
+        for r in results:
+            esg_info = r['esg_info']
+            value = esg_info.get('value')
+            columns['company'].append(esg_info.get('company'))
+            columns['year'].append(esg_info.get('year'))
+            columns['indicator'].append(esg_info.get('indicator'))
+            columns['value'].append(value)
+            # Rows from the query path carry the flag computed at ingest
+            columns['valid'].append(r['is_valid'] if 'is_valid' in r else _is_valid_value(value))
+            columns['rerank_score'].append(r.get('rerank_score', 0))
+        return columns
+    
+    @staticmethod
+    def _or_na(value: Any) -> Any:
+        """Display placeholder for a missing field"""
+        return 'N/A' if value is None else value
+    
+    @staticmethod
+    def _valid_mask(flags: List[bool]) -> np.ndarray:
+        """Boolean mask of rows with usable values"""
+        return np.fromiter(flags, dtype=bool, count=len(flags))
+    
+    @staticmethod
+    def _year_array(years: List[Any]) -> np.ndarray:
+        """Years as int32 (-1 where missing or non-numeric)"""
+        return np.fromiter(
+            (int(y) if y and str(y).isdigit() else -1 for y in years),
+            dtype=np.int32, count=len(years)
+        )
+    
+    def _call_api(self, prompt: str) -> str:
+        """Call API"""
+        headers, data = self._build_request(prompt)
+        
         try:
-            response = requests.post(self.base_url, headers=headers, json=data, timeout=60)
+            response = self.session.post(self.base_url, headers=headers, data=_json_dumps(data), timeout=60)
             
             if response.status_code == 200:
-                result = response.json()
+                result = _json_loads(response.content)
                 return result['choices'][0]['message']['content']
             else:
                 raise Exception(f"API call failed: {response.status_code}, {response.text}")
@@ -156,19 +489,47 @@ Response:"""
         except Exception as e:
             raise Exception(f"API call exception: {str(e)}")
     
+    async def _call_api_async(self, client, prompt: str) -> str:
+        """Call API asynchronously on a shared httpx client"""
+        headers, data = self._build_request(prompt)
+        
+        try:
+            response = await client.post(self.base_url, headers=headers, content=_json_dumps(data))
+            
+            if response.status_code == 200:
+                result = _json_loads(response.content)
+                return result['choices'][0]['message']['content']
+            else:
+                raise Exception(f"API call failed: {response.status_code}, {response.text}")
+        except httpx.TimeoutException:
+            raise Exception("API call timeout, please check network connection")
+        except httpx.ConnectError:
+            raise Exception("Network connection error, please check network")
+        except Exception as e:
+            raise Exception(f"API call exception: {str(e)}")
+    
     def _fallback_response(self, query: str, results: List[Dict]) -> str:
         """Fallback response generation"""
         if not results:
             return "Sorry, no data related to your query was found. Please try adjusting your query conditions or check if the data exists."
         
         # Extract key information
-        companies = list(set([r['esg_info'].get('company', '') for r in results if r['esg_info'].get('company')]))
-        years = list(set([r['esg_info'].get('year', '') for r in results if r['esg_info'].get('year')]))
-        indicators = list(set([r['esg_info'].get('indicator', '') for r in results if r['esg_info'].get('indicator')]))
-        
-        # Analyze data quality
-        complete_data = [r for r in results if r['esg_info'].get('value') and str(r['esg_info'].get('value')).lower() != 'nan']
-        missing_data = len(results) - len(complete_data)
+        columns = self._columnize(results)
+        companies, years, indicators = set(), set(), set()
+        for company, year, indicator in zip(columns['company'], columns['year'], columns['indicator']):
+            if company:
+                companies.add(company)
+            if year:
+                years.add(year)
+            if indicator:
+                indicators.add(indicator)
+        companies, years, indicators = list(companies), list(years), list(indicators)
+        
+        # Analyze data quality and year range in one numeric pass
+        valid_count, year_min, year_max = _aggregate_rows(
+            self._valid_mask(columns['valid']), self._year_array(columns['year'])
+        )
+        missing_data = len(results) - valid_count
         
         # Build intelligent response
         response_parts = []
@@ -190,7 +551,7 @@ Response:"""
             response_parts.append(f"涉及的公司包括: {', '.join(companies[:3])}。")
         
         if years:
-            response_parts.append(f"数据年份范围: {min(years)}-{max(years)}。")
+            response_parts.append(f"数据年份范围: {year_min}-{year_max}。")
         
         if indicators:
             response_parts.append(f"主要指标包括: {', '.join(indicators[:3])}。")
@@ -211,102 +572,200 @@ Response:"""
         
         return " ".join(response_parts)
 
+# ESG professional terminology dictionary
+ESG_TERMS = {
+    # Environmental indicators
+    'environment': ('环境', 'environment', '环保', '排放', 'emission', '碳', 'carbon'),
+    'nitrogen_oxide': ('氮氧化物', 'nitrogen oxide', 'NOx', 'NO2'),
+    'voc_emissions': ('VOC排放', 'VOC emissions', '挥发性有机化合物', 'volatile organic compound'),
+    'carbon_monoxide': ('一氧化碳', 'carbon monoxide', 'CO'),
+    'methane': ('甲烷', 'methane', 'CH4'),
+    'particulate': ('颗粒物', 'particulate', 'PM', '粉尘'),
+    'energy_consumption': ('能源消耗', 'energy consumption', '能耗'),
+    'renewable_energy': ('可再生能源', 'renewable energy', '清洁能源'),
+    'water_emissions': ('水排放', 'water emissions', '废水排放'),
+    'hazardous_waste': ('危险废物', 'hazardous waste', '有害废物'),
+
+    # Social indicators
+    'social': ('社会', 'social', '社会责任', 'social responsibility'),
+    'workforce': ('劳动力', 'workforce', '员工', 'employee', '人员'),
+    'women_workforce': ('女性员工', 'women workforce', '女性劳动力', 'pct women', 'women percentage', 'Pct Women in Workforce'),
+    'diversity': ('多样性', 'diversity', '多元化'),
+    'safety': ('安全', 'safety', '职业安全', 'occupational safety'),
+    'training': ('培训', 'training', '教育', 'education'),
+    'community': ('社区', 'community', '社区参与', 'community engagement'),
+    'human_rights': ('人权', 'human rights', '员工权利', 'worker rights'),
+    'indigenous_rights': ('原住民权利', 'indigenous rights', '土著权利'),
+    'strikes': ('罢工', 'strikes', '劳资纠纷', 'labor disputes'),
+
+    # Governance indicators
+    'governance': ('治理', 'governance', '公司治理', 'corporate governance', 'G类', 'G类指标', 'governance指标'),
+    'board_diversity': ('董事会多样性', 'board diversity', '董事会多元化'),
+    'executive_compensation': ('高管薪酬', 'executive compensation', '管理层薪酬'),
+    'audit': ('审计', 'audit', '审计质量', 'audit quality'),
+    'transparency': ('透明度', 'transparency', '信息披露', 'disclosure'),
+    'ethics': ('道德', 'ethics', '商业道德', 'business ethics'),
+    'compliance': ('合规', 'compliance', '法规遵循', 'regulatory compliance'),
+    'risk_management': ('风险管理', 'risk management', '风险控制'),
+    'stakeholder': ('利益相关者', 'stakeholder', '股东', 'shareholder'),
+    'sustainability': ('可持续性', 'sustainability', '可持续发展'),
+    'financial_literacy': ('财务素养', 'financial literacy', 'Financial Literacy Programs'),
+    'management_diversity': ('管理层多样性', 'management diversity', 'Pct Minorities in Management'),
+
+    # ES indicators
+    'es_indicators': ('ES类', 'ES类指标', 'ES指标', 'ES类表现', 'ES表现'),
+    'environmental_social': ('环境社会', 'environmental social', 'ES', 'E&S')
+}
+
+# Flat (term_lower, category, term) table, lowercased once instead of per query
+_ESG_TERM_INDEX = tuple(
+    (term.lower(), category, term)
+    for category, terms in ESG_TERMS.items() for term in terms
+)
+
+def _build_esg_automaton():
+    """Build the single-pass ESG term matcher (None without pyahocorasick)"""
+    if not AHOCORASICK_AVAILABLE:
+        return None
+    
+    automaton = ahocorasick.Automaton()
+    for term_lower, category, term in _ESG_TERM_INDEX:
+        hits = automaton.get(term_lower, [])
+        hits.append((category, term))
+        automaton.add_word(term_lower, hits)
+    automaton.make_automaton()
+    return automaton
+
+# One automaton scan instead of a substring check per term
+_ESG_AUTOMATON = _build_esg_automaton()
+
+# Company name patterns (support ticker and company name)
+COMPANY_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    # Ticker patterns (priority matching)
+    r'([A-Z]{1,6}\s+US\s+Equity)',  # General ticker pattern (AA US Equity)
+    r'(A US Equity|B US Equity|C US Equity|AA US Equity)',  # Specific ticker patterns
+    # Company name patterns
+    r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings))',
+    r'([A-Za-z\s]+(?:Inc\.|Corp\.|Ltd\.|Company\.))',
+    r'([A-Za-z\s]+(?:Technologies|Systems|Group|Holdings))',
+    # Mixed patterns
+    r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings)\s*\([A-Z]{1,6}\s+US\s+Equity\))',  # Company (Ticker)
+    r'([A-Z]{1,6}\s+US\s+Equity\s*\([A-Za-z\s]+\))'  # Ticker (Company)
+])
+
+# Year patterns
+YEAR_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'in\s+year\s+(\d{4})',  # in year 2006
+    r'in\s+(\d{4})',        # in 2006
+    r'year\s+(\d{4})',      # year 2006
+    r'(\d{4})年',
+    r'(\d{4})',
+    r'(\d{4})年数据',
+    r'(\d{4})年度'
+])
+
+# Indicator code patterns
+INDICATOR_CODE_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'ES\d{3}',
+    r'ES\d{2}',
+    r'code=ES\d{3}',
+    r'指标代码[：:]\s*ES\d{3}',
+    r'ES\d{3}指标'
+])
+
+# Indicator name patterns (matched against the lowercased query)
+_ENV_PATTERNS = [
+    r'(nitrogen\s+oxide\s+emissions?)',
+    r'(carbon\s+dioxide\s+emissions?)',
+    r'(methane\s+emissions?)',
+    r'(voc\s+emissions?)',
+    r'(particulate\s+matter)',
+    r'(water\s+emissions?)',
+    r'(energy\s+consumption)',
+    r'(renewable\s+energy)',
+    r'(hazardous\s+waste)'
+]
+_SOCIAL_PATTERNS = [
+    r'(women\s+workforce)',
+    r'(pct\s+women\s+in\s+workforce)',
+    r'(employee\s+diversity)',
+    r'(workforce\s+diversity)',
+    r'(safety\s+training)',
+    r'(community\s+engagement)',
+    r'(human\s+rights)',
+    r'(labor\s+rights)'
+]
+_GOV_PATTERNS = [
+    r'(board\s+diversity)',
+    r'(executive\s+compensation)',
+    r'(audit\s+quality)',
+    r'(transparency)',
+    r'(corporate\s+governance)',
+    r'(risk\s+management)',
+    r'(stakeholder\s+engagement)'
+]
+# One alternation scan; the lookahead keeps overlapping hits (e.g. "women workforce diversity")
+_INDICATOR_NAME_RE = re.compile(
+    '(?=(' + '|'.join(f'(?:{p})' for p in _ENV_PATTERNS + _SOCIAL_PATTERNS + _GOV_PATTERNS) + '))'
+)
+
+# Context carry-over patterns
+_CONTEXT_COMPANY_RE = re.compile(r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings|US Equity))')
+_CONTEXT_INDICATOR_RE = re.compile(r'([A-Za-z\s]+(?:Emissions|Consumption|Policy|Rights|Workforce|Diversity))')
+
+# Query cleaning patterns
+_WS_RE = re.compile(r'\s+')
+_SPECIAL_RE = re.compile(r'[^\w\s:,.()%-]')
+
+# Query intent classification
+QUERY_INTENTS = {
+    'trend': ('趋势', 'trend', '变化', 'change', '发展', 'development', '演变', 'evolution'),
+    'comparison': ('比较', 'compare', '对比', '对比分析', 'comparative', 'vs', 'versus'),
+    'specific': ('具体', 'specific', '详细', 'detail', '具体数据', 'specific data'),
+    'overview': ('概览', 'overview', '总体', 'overall', '整体', 'general', '综合'),
+    'analysis': ('分析', 'analysis', '研究', 'research', '评估', 'evaluation')
+}
+
 class OptimizedQueryProcessor:
     """Optimized Query Processor"""
     
     def __init__(self):
         """Initialize Query Processor"""
         
-        # ESG professional terminology dictionary
-        self.esg_terms = {
-            # Environmental indicators
-            'environment': ['环境', 'environment', '环保', '排放', 'emission', '碳', 'carbon'],
-            'nitrogen_oxide': ['氮氧化物', 'nitrogen oxide', 'NOx', 'NO2'],
-            'voc_emissions': ['VOC排放', 'VOC emissions', '挥发性有机化合物', 'volatile organic compound'],
-            'carbon_monoxide': ['一氧化碳', 'carbon monoxide', 'CO'],
-            'methane': ['甲烷', 'methane', 'CH4'],
-            'particulate': ['颗粒物', 'particulate', 'PM', '粉尘'],
-            'energy_consumption': ['能源消耗', 'energy consumption', '能耗'],
-            'renewable_energy': ['可再生能源', 'renewable energy', '清洁能源'],
-            'water_emissions': ['水排放', 'water emissions', '废水排放'],
-            'hazardous_waste': ['危险废物', 'hazardous waste', '有害废物'],
-            
-            # Social indicators
-            'social': ['社会', 'social', '社会责任', 'social responsibility'],
-            'workforce': ['劳动力', 'workforce', '员工', 'employee', '人员'],
-            'women_workforce': ['女性员工', 'women workforce', '女性劳动力', 'pct women', 'women percentage', 'Pct Women in Workforce'],
-            'diversity': ['多样性', 'diversity', '多元化'],
-            'safety': ['安全', 'safety', '职业安全', 'occupational safety'],
-            'training': ['培训', 'training', '教育', 'education'],
-            'community': ['社区', 'community', '社区参与', 'community engagement'],
-            'human_rights': ['人权', 'human rights', '员工权利', 'worker rights'],
-            'indigenous_rights': ['原住民权利', 'indigenous rights', '土著权利'],
-            'strikes': ['罢工', 'strikes', '劳资纠纷', 'labor disputes'],
-            
-            # Governance indicators
-            'governance': ['治理', 'governance', '公司治理', 'corporate governance', 'G类', 'G类指标', 'governance指标'],
-            'board_diversity': ['董事会多样性', 'board diversity', '董事会多元化'],
-            'executive_compensation': ['高管薪酬', 'executive compensation', '管理层薪酬'],
-            'audit': ['审计', 'audit', '审计质量', 'audit quality'],
-            'transparency': ['透明度', 'transparency', '信息披露', 'disclosure'],
-            'ethics': ['道德', 'ethics', '商业道德', 'business ethics'],
-            'compliance': ['合规', 'compliance', '法规遵循', 'regulatory compliance'],
-            'risk_management': ['风险管理', 'risk management', '风险控制'],
-            'stakeholder': ['利益相关者', 'stakeholder', '股东', 'shareholder'],
-            'sustainability': ['可持续性', 'sustainability', '可持续发展'],
-            'financial_literacy': ['财务素养', 'financial literacy', 'Financial Literacy Programs'],
-            'management_diversity': ['管理层多样性', 'management diversity', 'Pct Minorities in Management'],
-            
-            # ES indicators
-            'es_indicators': ['ES类', 'ES类指标', 'ES指标', 'ES类表现', 'ES表现'],
-            'environmental_social': ['环境社会', 'environmental social', 'ES', 'E&S']
-        }
-        
-        # Company name patterns (support ticker and company name)
-        self.company_patterns = [
-            # Ticker patterns (priority matching)
-            r'([A-Z]{1,6}\s+US\s+Equity)',  # General ticker pattern (AA US Equity)
-            r'(A US Equity|B US Equity|C US Equity|AA US Equity)',  # Specific ticker patterns
-            # Company name patterns
-            r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings))',
-            r'([A-Za-z\s]+(?:Inc\.|Corp\.|Ltd\.|Company\.))',
-            r'([A-Za-z\s]+(?:Technologies|Systems|Group|Holdings))',
-            # Mixed patterns
-            r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings)\s*\([A-Z]{1,6}\s+US\s+Equity\))',  # Company (Ticker)
-            r'([A-Z]{1,6}\s+US\s+Equity\s*\([A-Za-z\s]+\))'  # Ticker (Company)
-        ]
-        
-        # Year patterns
-        self.year_patterns = [
-            r'in\s+year\s+(\d{4})',  # in year 2006
-            r'in\s+(\d{4})',        # in 2006
-            r'year\s+(\d{4})',      # year 2006
-            r'(\d{4})年',
-            r'(\d{4})',
-            r'(\d{4})年数据',
-            r'(\d{4})年度'
-        ]
-        
-        # Indicator code patterns
-        self.indicator_code_patterns = [
-            r'ES\d{3}',
-            r'ES\d{2}',
-            r'code=ES\d{3}',
-            r'指标代码[：:]\s*ES\d{3}',
-            r'ES\d{3}指标'
-        ]
-        
-        # Query intent classification
-        self.query_intents = {
-            'trend': ['趋势', 'trend', '变化', 'change', '发展', 'development', '演变', 'evolution'],
-            'comparison': ['比较', 'compare', '对比', '对比分析', 'comparative', 'vs', 'versus'],
-            'specific': ['具体', 'specific', '详细', 'detail', '具体数据', 'specific data'],
-            'overview': ['概览', 'overview', '总体', 'overall', '整体', 'general', '综合'],
-            'analysis': ['分析', 'analysis', '研究', 'research', '评估', 'evaluation']
-        }
+        # Pattern tables and matchers are module-level, shared by every instance
+        self.esg_terms = ESG_TERMS
+        self.company_patterns = COMPANY_PATTERNS
+        self.year_patterns = YEAR_PATTERNS
+        self.indicator_code_patterns = INDICATOR_CODE_PATTERNS
+        self.query_intents = QUERY_INTENTS
+        self._esg_term_index = _ESG_TERM_INDEX
+        self._esg_automaton = _ESG_AUTOMATON
+        self._indicator_re = _INDICATOR_NAME_RE
+        self._context_company_re = _CONTEXT_COMPANY_RE
+        self._context_indicator_re = _CONTEXT_INDICATOR_RE
+        self._ws_re = _WS_RE
+        self._special_re = _SPECIAL_RE
+        
+        # Per-instance parse cache keyed by (raw_query, previous_query)
+        self._process_query_cached = functools.lru_cache(maxsize=1024)(self._process_query_uncached)
     
     def process_query(self, raw_query: str, context: Dict = None) -> Dict[str, Any]:
         """Process raw query and return structured information"""
+        previous_query = context.get('previous_query') if context else None
+        analysis = self._process_query_cached(raw_query, previous_query)
+        
+        # Hand out copies so callers cannot mutate the cached entry
+        result = dict(analysis)
+        result['extracted_info'] = {key: list(values) for key, values in analysis['extracted_info'].items()}
+        result['timestamp'] = datetime.now().isoformat()
+        return result
+    
+    def process_batch(self, raw_queries: List[str]) -> List[Dict[str, Any]]:
+        """Process several independent queries (no context carry-over between them)"""
+        return [self.process_query(raw_query) for raw_query in raw_queries]
+    
+    def _process_query_uncached(self, raw_query: str, previous_query: Optional[str]) -> Dict[str, Any]:
+        """Parse a query (cached by process_query)"""
         # 1. Basic cleaning
         cleaned_query = self._clean_query(raw_query)
         
@@ -314,8 +773,8 @@ class OptimizedQueryProcessor:
         extracted_info = self._extract_key_information(cleaned_query)
         
         # 3. Handle context (e.g., "what about 2016?")
-        if context and 'previous_query' in context:
-            extracted_info = self._handle_context(extracted_info, context['previous_query'])
+        if previous_query:
+            extracted_info = self._handle_context(extracted_info, previous_query)
         
         # 4. Identify query intent
         intent = self._identify_intent(cleaned_query)
@@ -329,21 +788,20 @@ class OptimizedQueryProcessor:
             'extracted_info': extracted_info,
             'intent': intent,
             'optimized_query': optimized_query,
-            'confidence': self._calculate_confidence(extracted_info),
-            'timestamp': datetime.now().isoformat()
+            'confidence': self._calculate_confidence(extracted_info)
         }
     
     def _handle_context(self, extracted_info: Dict, previous_query: str) -> Dict:
         """Handle contextual queries"""
         # If current query lacks company info, get from previous query
         if not extracted_info['companies']:
-            prev_companies = re.findall(r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings|US Equity))', previous_query)
+            prev_companies = self._context_company_re.findall(previous_query)
             if prev_companies:
                 extracted_info['companies'] = prev_companies
         
         # If current query lacks indicator info, get from previous query
         if not extracted_info['indicators'] and not extracted_info['indicator_codes']:
-            prev_indicators = re.findall(r'([A-Za-z\s]+(?:Emissions|Consumption|Policy|Rights|Workforce|Diversity))', previous_query)
+            prev_indicators = self._context_indicator_re.findall(previous_query)
             if prev_indicators:
                 extracted_info['indicators'] = prev_indicators
         
@@ -352,16 +810,16 @@ class OptimizedQueryProcessor:
     def _clean_query(self, query: str) -> str:
         """Clean query text"""
         # Remove extra spaces
-        query = re.sub(r'\s+', ' ', query.strip())
+        query = self._ws_re.sub(' ', query.strip())
         
         # Standardize punctuation
         query = query.replace('：', ':').replace('，', ',').replace('。', '.')
         
         # Remove special characters but keep important symbols
-        query = re.sub(r'[^\w\s:,.()%-]', ' ', query)
+        query = self._special_re.sub(' ', query)
         
         # Clean spaces again
-        query = re.sub(r'\s+', ' ', query.strip())
+        query = self._ws_re.sub(' ', query.strip())
         
         return query
     
@@ -382,7 +840,7 @@ class OptimizedQueryProcessor:
         
         # 1. 提取公司信息（优先匹配ticker）
         for pattern in self.company_patterns:
-            matches = re.findall(pattern, query, re.IGNORECASE)
+            matches = pattern.findall(query)
             for match in matches:
                 if isinstance(match, tuple):
                     match = match[0] if match[0] else match[1]
@@ -391,7 +849,7 @@ class OptimizedQueryProcessor:
         
         # 2. 提取年份信息
         for pattern in self.year_patterns:
-            matches = re.findall(pattern, query, re.IGNORECASE)
+            matches = pattern.findall(query)
             for match in matches:
                 if isinstance(match, tuple):
                     match = match[0] if match[0] else match[1]
@@ -400,7 +858,7 @@ class OptimizedQueryProcessor:
         
         # 3. 提取指标代码
         for pattern in self.indicator_code_patterns:
-            matches = re.findall(pattern, query, re.IGNORECASE)
+            matches = pattern.findall(query)
             info['indicator_codes'].extend(matches)
         
         # 4. 智能识别指标名称
@@ -408,11 +866,9 @@ class OptimizedQueryProcessor:
         info['indicators'].extend(indicators)
         
         # 5. 识别ESG类别
-        for category, terms in self.esg_terms.items():
-            for term in terms:
-                if term.lower() in query_lower:
-                    info['esg_categories'].append(category)
-                    info['keywords'].append(term)
+        for category, term in self._match_esg_terms(query_lower):
+            info['esg_categories'].append(category)
+            info['keywords'].append(term)
         
         # 去重并过滤
         for key in ['companies', 'years', 'indicators', 'indicator_codes', 'values', 'esg_categories', 'keywords']:
@@ -420,54 +876,18 @@ class OptimizedQueryProcessor:
         
         return info
     
+    def _match_esg_terms(self, query_lower: str) -> List[tuple]:
+        """匹配ESG术语，返回 (category, term) 列表"""
+        if self._esg_automaton is not None:
+            return [hit for _, hits in self._esg_automaton.iter(query_lower) for hit in hits]
+        
+        # Substring (not word-token) semantics: CJK terms such as '碳' occur inside '碳排放'
+        return [(category, term) for term_lower, category, term in self._esg_term_index
+                if term_lower in query_lower]
+    
     def _extract_indicator_names(self, query: str) -> List[str]:
         """智能提取指标名称"""
-        indicators = []
-        query_lower = query.lower()
-        
-        # 环境指标
-        env_patterns = [
-            r'(nitrogen\s+oxide\s+emissions?)',
-            r'(carbon\s+dioxide\s+emissions?)',
-            r'(methane\s+emissions?)',
-            r'(voc\s+emissions?)',
-            r'(particulate\s+matter)',
-            r'(water\s+emissions?)',
-            r'(energy\s+consumption)',
-            r'(renewable\s+energy)',
-            r'(hazardous\s+waste)'
-        ]
-        
-        # 社会指标
-        social_patterns = [
-            r'(women\s+workforce)',
-            r'(pct\s+women\s+in\s+workforce)',
-            r'(employee\s+diversity)',
-            r'(workforce\s+diversity)',
-            r'(safety\s+training)',
-            r'(community\s+engagement)',
-            r'(human\s+rights)',
-            r'(labor\s+rights)'
-        ]
-        
-        # 治理指标
-        gov_patterns = [
-            r'(board\s+diversity)',
-            r'(executive\s+compensation)',
-            r'(audit\s+quality)',
-            r'(transparency)',
-            r'(corporate\s+governance)',
-            r'(risk\s+management)',
-            r'(stakeholder\s+engagement)'
-        ]
-        
-        all_patterns = env_patterns + social_patterns + gov_patterns
-        
-        for pattern in all_patterns:
-            matches = re.findall(pattern, query_lower)
-            indicators.extend(matches)
-        
-        return indicators
+        return [m.group(1) for m in self._indicator_re.finditer(query.lower())]
     
     def _identify_intent(self, query: str) -> str:
         """识别查询意图"""
@@ -566,28 +986,156 @@ class OptimizedQueryProcessor:
         
         return min(confidence, 1.0)
 
+# Document field extraction patterns for FixedMemoRAG.extract_esg_info (tried in order, first match wins)
+_DOC_COMPANY_PATTERNS = tuple(re.compile(p) for p in [
+    r'([^（]+)（',  # Chinese format: company name（
+    r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings))',  # English format
+    r'([A-Z]{1,6}\s+US\s+Equity)',  # Ticker format
+])
+
+_DOC_YEAR_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'在(\d{4})年',  # Chinese format: 在2006年
+    r'(\d{4})',      # Simple number format
+    r'year\s+(\d{4})',  # year 2006
+    r'in\s+(\d{4})',   # in 2006
+])
+
+_DOC_INDICATOR_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'：([^（]+)（',  # 中文格式：指标名（
+    r'([A-Za-z\s]+(?:Emissions|Consumption|Policy|Rights|Workforce|Diversity|Governance))',  # 英文指标
+    r'(nitrogen\s+oxide\s+emissions?)',  # 具体指标
+    r'(carbon\s+dioxide\s+emissions?)',
+    r'(methane\s+emissions?)',
+    r'(voc\s+emissions?)',
+    r'(women\s+workforce)',
+    r'(pct\s+women\s+in\s+workforce)',
+])
+
+_DOC_CODE_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in [
+    r'code=([^）]+)',  # code=ES001
+    r'(ES\d{3})',      # ES001
+    r'(ES\d{2})',     # ES01
+])
+
+_DOC_VALUE_PATTERNS = tuple(re.compile(p) for p in [
+    r'= ([^,]+)',     # = 42.6
+    r':\s*([^,\s]+)', # : 42.6
+    r'(\d+\.?\d*)',   # 简单数字
+    r'(True|False)',  # 布尔值
+])
+
+# Lowercased ticker -> company-name fragments that also count as a company match
+TICKER_ALIASES = {
+    'a us equity': ('agilent',),
+}
+
+# Ticker-form company mentions that can be pushed down as an exact ticker filter
+_TICKER_RE = re.compile(r'([A-Za-z]{1,6})\s+US\s+Equity', re.IGNORECASE)
+
+# Complete indicator codes, safe to push down as exact matches
+_FULL_CODE_RE = re.compile(r'ES\d{3}')
+
+# Filtered subsets up to this size are scored exactly instead of through the ANN graph
+_EXACT_FILTER_ROWS = 16384
+
+# Collections larger than this are searched through Chroma even when local_index is on
+LOCAL_INDEX_MAX_ROWS = 200000
+
+# Upper bound on hits fetched when post-filtering needs a wider search
+_MAX_OVERFETCH = 200
+
+# Basic (non-LLM) response templates, keyed by (language, intent):
+# (opening, found, companies, years, indicators, trend, suggestion)
+_BASIC_OPENINGS = {
+    'zh': {'trend': "根据趋势分析，", 'comparison': "通过对比分析，",
+           'specific': "具体数据显示，", 'general': "根据查询结果，"},
+    'en': {'trend': "Based on trend analysis,", 'comparison': "Through comparative analysis,",
+           'specific': "Specific data shows,", 'general': "Based on query results,"},
+}
+_BASIC_BODIES = {
+    'zh': ("我找到了 {} 条相关数据。",
+           "涉及的公司包括: {}。",
+           "数据年份范围: {}-{}。",
+           "主要指标包括: {}。",
+           "从时间维度看，数据呈现一定的变化趋势。",
+           "建议您查看具体数据详情以获取更准确的信息。"),
+    'en': ("I found {} relevant data records.",
+           "Companies involved include: {}.",
+           "Data year range: {}-{}.",
+           "Main indicators include: {}.",
+           "From a temporal perspective, the data shows certain trends.",
+           "I recommend reviewing specific data details for more accurate information."),
+}
+_BASIC_RESPONSE_TEMPLATES = {
+    (lang, intent): (opening,) + _BASIC_BODIES[lang]
+    for lang, openings in _BASIC_OPENINGS.items()
+    for intent, opening in openings.items()
+}
+_BASIC_NO_RESULTS = {
+    'zh': "很抱歉，没有找到与您查询相关的数据。请尝试调整查询条件或检查数据是否存在。",
+    'en': "Sorry, no data related to your query was found. Please try adjusting your query conditions or check if the data exists.",
+}
+
+# Live FixedMemoRAG instances; one exit hook flushes them without keeping them alive
+_OPEN_SYSTEMS = weakref.WeakSet()
+
+@atexit.register
+def _close_open_systems():
+    for system in list(_OPEN_SYSTEMS):
+        system.close()
+
 class FixedMemoRAG:
     """Fixed MemoRAG System"""
     
     def __init__(self, db_path: str, model_name: str = "BAAI/bge-m3", 
-                 memory_size: int = 1000, llm_api_key: str = None, language: str = "en"):
+                 memory_size: int = 1000, llm_api_key: str = None, language: str = "en",
+                 local_index: bool = False, quantize_index: bool = False, ann_index: bool = False,
+                 device: Optional[str] = None, half_precision: Optional[bool] = None,
+                 local_index_max_rows: int = LOCAL_INDEX_MAX_ROWS,
+                 semantic_response_cache: bool = False):
         """Initialize Fixed MemoRAG System"""
         self.db_path = db_path
         self.model_name = model_name
         self.memory_size = memory_size
         self.language = language  # "en" for English, "zh" for Chinese
         
+        # In-memory embedding matrices per collection (vectorized top-k instead of Chroma query), opt-in
+        self.local_index = local_index
+        self.local_index_max_rows = local_index_max_rows  # larger collections stay on Chroma query
+        self.quantize_index = quantize_index  # int8 rows + per-row scale (4x less memory traffic)
+        self.ann_index = ann_index  # FAISS HNSW graph for sub-linear top-k (requires faiss)
+        # Encoder placement: CUDA when available; fp16 by default on GPU, fp32 on CPU unless requested
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        if half_precision is None:
+            half_precision = self.device.startswith('cuda')
+        self.half_precision = half_precision  # fp16 (GPU) / bf16 (CPU) encoder forward pass
+        # bf16 on CPU: relax float32 matmul precision only while encoding
+        self.matmul_precision = 'medium' if half_precision and not self.device.startswith('cuda') else None
+        self._local_indexes = {}  # collection name -> (row count at load, index or None)
+        self._collections_cache = None  # list_collections() result, see invalidate_collections()
+        if ann_index and not FAISS_AVAILABLE:
+            print("⚠️ faiss not installed, falling back to exact vectorized search")
+        elif ann_index:
+            faiss.omp_set_num_threads(os.cpu_count() or 1)
+        
         # Initialize translation dictionary
         self.translations = self._init_translations()
+        self.set_language(language)
         
         # Initialize Chroma client
         self.client = chromadb.PersistentClient(path=db_path)
         
         # Load BGE model
-        print(f"🔬 {self.t('loading_model')}: {model_name}")
-        self.model = SentenceTransformer(model_name)
+        print(f"🔬 {self.t('loading_model')}: {model_name} ({self.device}{', half precision' if self.half_precision else ''})")
+        self.model = _load_model(model_name, self.device, self.half_precision)
         print(f"✅ {self.t('model_loaded')}")
         
+        # LRU cache of query embeddings, persisted across restarts (saved at exit)
+        self.embedding_cache_size = 4096
+        self._query_embeddings = OrderedDict()
+        self._query_embeddings_dirty = False
+        self.load_embedding_cache()
+        
         # Check embedding dimensions
         test_embedding = self.model.encode(["test"])
         print(f"📏 {self.t('embedding_dimension')}: {len(test_embedding[0])}")
@@ -595,12 +1143,11 @@ class FixedMemoRAG:
         # Check Chroma database embedding dimensions
         try:
             # Get all collections
-            collections = self.client.list_collections()
+            collections = self._list_collections()
             if collections:
                 # Use first collection to check dimensions
-                sample = self.client.get_collection(name=collections[0].name).get(limit=1, include=['embeddings'])
-                if sample['embeddings']:
-                    chroma_dim = len(sample['embeddings'][0])
+                chroma_dim = self._collection_dimension(self.client.get_collection(name=collections[0].name))
+                if chroma_dim is not None:
                     print(f"📏 {self.t('chroma_dimension')}: {chroma_dim}")
                     if chroma_dim != len(test_embedding[0]):
                         print(f"⚠️ {self.t('dimension_mismatch')} BGE: {len(test_embedding[0])}, Chroma: {chroma_dim}")
@@ -617,7 +1164,9 @@ class FixedMemoRAG:
         
         # Initialize LLM response generator
         if llm_api_key:
-            self.llm_generator = LLMResponseGenerator(llm_api_key)
+            # Near-duplicate answer reuse is opt-in (it still requires identical retrieved results)
+            encoder = self.encode_queries if semantic_response_cache else None
+            self.llm_generator = LLMResponseGenerator(llm_api_key, encoder=encoder)
             print(f"🤖 {self.t('llm_initialized')}")
         else:
             self.llm_generator = None
@@ -636,9 +1185,17 @@ class FixedMemoRAG:
             'trends': {},
             'last_update': None
         }
+        # Company/year popularity over the retained queries, kept up to date as queries are added or trimmed
+        self._company_counts = Counter()
+        self._year_counts = Counter()
+        
+        # New memory entries go to an append-only log, compacted into the JSON snapshot every N entries and on close()
+        self.memory_compact_every = 100
+        self._memory_log = None
+        self._memory_log_entries = 0
         
         # Get all collections
-        self.collections = self.client.list_collections()
+        self.collections = self._list_collections()
         print(f"📊 Found {len(self.collections)} {self.t('collections_found')}")
         
         # Display collection information
@@ -663,6 +1220,21 @@ class FixedMemoRAG:
         # Answer mode management
         self.use_llm = llm_api_key is not None
         self.debug_mode = False
+        
+        # Flushed by close(), or by the exit hook if close() is never called
+        _OPEN_SYSTEMS.add(self)
+    
+    def close(self):
+        """Persist the query embedding cache and compact the memory log (safe to call more than once)"""
+        _OPEN_SYSTEMS.discard(self)
+        self.save_embedding_cache()
+        self._compact_memory()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def _init_translations(self) -> Dict[str, Dict[str, str]]:
         """Initialize translation dictionary"""
@@ -785,18 +1357,127 @@ class FixedMemoRAG:
             "more_data_available": {"en": "more data available", "zh": "条数据"},
         }
     
+    def set_language(self, language: str):
+        """Switch display language and rebuild the flat translation table"""
+        self.language = language
+        self._t_cache = {key: texts.get(language, texts["en"]) for key, texts in self.translations.items()}
+    
     def t(self, key: str) -> str:
         """Get translated text"""
-        if key in self.translations:
-            return self.translations[key].get(self.language, self.translations[key]["en"])
-        return key
+        return self._t_cache.get(key, key)
+    
+    def _list_collections(self) -> List[Any]:
+        """List Chroma collections (cached until invalidate_collections())"""
+        if self._collections_cache is None:
+            self._collections_cache = self.client.list_collections()
+        return self._collections_cache
+    
+    def invalidate_collections(self):
+        """Drop cached collection list and local indexes (call after collections are created, rebuilt or deleted)"""
+        self._collections_cache = None
+        self._local_indexes.clear()
+        self.collections = self._list_collections()
+    
+    def _collection_dimension(self, collection) -> Optional[int]:
+        """Embedding dimension of a collection (cached in a sidecar file across restarts)"""
+        cache_file = os.path.join(self.db_path, '.dim_cache.json')
+        # Collection id changes when a collection is dropped and rebuilt
+        cache_key = f"{collection.name}:{collection.id}"
+        
+        dim_cache = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    dim_cache = _json_loads(f.read())
+            except Exception:
+                dim_cache = {}
+        if cache_key in dim_cache:
+            return dim_cache[cache_key]
+        
+        sample = collection.get(limit=1, include=['embeddings'])
+        if sample['embeddings'] is None or len(sample['embeddings']) == 0:
+            return None
+        
+        dim_cache[cache_key] = len(sample['embeddings'][0])
+        try:
+            with open(cache_file, 'wb') as f:
+                f.write(_json_dumps(dim_cache))
+        except Exception as e:
+            print(f"Failed to save dimension cache: {str(e)}")
+        return dim_cache[cache_key]
+    
+    def encode_batch(self, texts: List[str]) -> np.ndarray:
+        """Encode texts in one batched forward pass (normalized float32 embeddings)"""
+        with _matmul_precision(self.matmul_precision):
+            embeddings = self.model.encode(texts, batch_size=64, convert_to_numpy=True,
+                                           normalize_embeddings=True, show_progress_bar=False)
+        # Half-precision models still hand float32 to the downstream BLAS/FAISS code
+        return np.asarray(embeddings, dtype=np.float32)
+    
+    def encode_queries(self, texts: List[str]) -> np.ndarray:
+        """Encode query texts, reusing cached embeddings and batch-encoding only the misses"""
+        cache = self._query_embeddings
+        misses = list(dict.fromkeys(text for text in texts if text not in cache))
+        if misses:
+            for text, embedding in zip(misses, self.encode_batch(misses)):
+                cache[text] = embedding
+            self._query_embeddings_dirty = True
+        
+        embeddings = []
+        for text in texts:
+            cache.move_to_end(text)
+            embeddings.append(cache[text])
+        while len(cache) > self.embedding_cache_size:
+            cache.popitem(last=False)
+        return np.stack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+    
+    def save_embedding_cache(self):
+        """Persist the query embedding cache as texts + float32 matrix in an .npz (atomic replace)"""
+        if not self._query_embeddings_dirty or not self._query_embeddings:
+            return
+        cache_file = os.path.join(self.db_path, 'emb_cache.npz')
+        tmp_file = cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, model=np.array(self.model_name),
+                         texts=np.array(list(self._query_embeddings)),
+                         embeddings=np.stack(list(self._query_embeddings.values())).astype(np.float32))
+            os.replace(tmp_file, cache_file)
+            self._query_embeddings_dirty = False
+        except Exception as e:
+            print(f"Failed to save embedding cache: {str(e)}")
+    
+    def load_embedding_cache(self):
+        """Load the query embedding cache written for the same model"""
+        cache_file = os.path.join(self.db_path, 'emb_cache.npz')
+        if not os.path.exists(cache_file):
+            return
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                if str(data['model']) == self.model_name:
+                    self._query_embeddings = OrderedDict(zip(data['texts'].tolist(), data['embeddings']))
+        except Exception as e:
+            print(f"Failed to load embedding cache: {str(e)}")
+    
+    def intelligent_query_batch(self, raw_queries: List[str], collection_name: str = None,
+                                n_results: int = 10) -> List[Dict[str, Any]]:
+        """Run several independent queries, encoding all optimized queries in a single batch"""
+        analyses = self.query_processor.process_batch(raw_queries)
+        embeddings = self.encode_queries([analysis['optimized_query'] for analysis in analyses])
+        
+        return [
+            self.intelligent_query(raw_query, collection_name, n_results,
+                                   query_analysis=analysis, query_embedding=embedding)
+            for raw_query, analysis, embedding in zip(raw_queries, analyses, embeddings)
+        ]
     
     def intelligent_query(self, raw_query: str, collection_name: str = None, 
-                        n_results: int = 10, use_memory: bool = True) -> Dict[str, Any]:
+                        n_results: int = 10, use_memory: bool = True,
+                        query_analysis: Dict = None, query_embedding: np.ndarray = None) -> Dict[str, Any]:
         """Intelligent query (supports natural language)"""
         # Auto-detect collection name
         if collection_name is None:
-            collections = self.client.list_collections()
+            collections = self._list_collections()
             if collections:
                 collection_name = collections[0].name
                 print(f"🔍 {self.t('auto_detected_collection')}: {collection_name}")
@@ -811,9 +1492,10 @@ class FixedMemoRAG:
                     'timestamp': datetime.now().isoformat()
                 }
         
-        # 1. Process query (with context)
-        context = {'previous_query': self.last_query} if self.last_query else None
-        query_analysis = self.query_processor.process_query(raw_query, context)
+        # 1. Process query (with context), unless already analyzed by a batch
+        if query_analysis is None:
+            context = {'previous_query': self.last_query} if self.last_query else None
+            query_analysis = self.query_processor.process_query(raw_query, context)
         
         # Debug mode: display query analysis
         if self.debug_mode:
@@ -836,7 +1518,7 @@ class FixedMemoRAG:
         self.last_query = raw_query
         
         # 3. Execute query
-        results = self._execute_query_with_post_filter(query_analysis, collection_name, n_results)
+        results = self._execute_query_with_post_filter(query_analysis, collection_name, n_results, query_embedding)
         
         # 4. Generate insights
         insights = self._generate_insights(results, query_analysis)
@@ -873,79 +1555,41 @@ class FixedMemoRAG:
     
     def _generate_basic_response(self, query: str, results: List[Dict], query_analysis: Dict) -> str:
         """Generate basic response"""
+        lang = 'zh' if self.language == 'zh' else 'en'
         if not results:
-            if self.language == 'zh':
-                return "很抱歉，没有找到与您查询相关的数据。请尝试调整查询条件或检查数据是否存在。"
-            else:
-                return "Sorry, no data related to your query was found. Please try adjusting your query conditions or check if the data exists."
+            return _BASIC_NO_RESULTS[lang]
         
         # Analyze query intent
         intent = query_analysis['intent']
-        extracted_info = query_analysis['extracted_info']
+        opening, found, companies_tpl, years_tpl, indicators_tpl, trend, suggestion = _BASIC_RESPONSE_TEMPLATES.get(
+            (lang, intent), _BASIC_RESPONSE_TEMPLATES[(lang, 'general')])
         
-        response_parts = []
-        
-        # Opening
-        if self.language == 'zh':
-            if intent == 'trend':
-                response_parts.append("根据趋势分析，")
-            elif intent == 'comparison':
-                response_parts.append("通过对比分析，")
-            elif intent == 'specific':
-                response_parts.append("具体数据显示，")
-            else:
-                response_parts.append("根据查询结果，")
-        else:
-            if intent == 'trend':
-                response_parts.append("Based on trend analysis,")
-            elif intent == 'comparison':
-                response_parts.append("Through comparative analysis,")
-            elif intent == 'specific':
-                response_parts.append("Specific data shows,")
-            else:
-                response_parts.append("Based on query results,")
+        # Data statistics (one pass over results)
+        companies, years, indicators = set(), set(), set()
+        for r in results:
+            esg_info = r['esg_info']
+            if esg_info.get('company'):
+                companies.add(esg_info['company'])
+            if esg_info.get('year'):
+                years.add(esg_info['year'])
+            if esg_info.get('indicator'):
+                indicators.add(esg_info['indicator'])
+        companies, years, indicators = list(companies), list(years), list(indicators)
+        
+        response_parts = [opening, found.format(len(results))]
+        if companies:
+            response_parts.append(companies_tpl.format(', '.join(companies[:3])))
+        if years:
+            response_parts.append(years_tpl.format(*_min_max(years)))
+        if indicators:
+            response_parts.append(indicators_tpl.format(', '.join(indicators[:3])))
         
-        # Data statistics
-        companies = list(set([r['esg_info'].get('company', '') for r in results if r['esg_info'].get('company')]))
-        years = list(set([r['esg_info'].get('year', '') for r in results if r['esg_info'].get('year')]))
-        indicators = list(set([r['esg_info'].get('indicator', '') for r in results if r['esg_info'].get('indicator')]))
+        # Trend analysis
+        if len(results) > 1 and years:
+            response_parts.append(trend)
         
-        if self.language == 'zh':
-            response_parts.append(f"我找到了 {len(results)} 条相关数据。")
-            
-            if companies:
-                response_parts.append(f"涉及的公司包括: {', '.join(companies[:3])}。")
-            
-            if years:
-                response_parts.append(f"数据年份范围: {min(years)}-{max(years)}。")
-            
-            if indicators:
-                response_parts.append(f"主要指标包括: {', '.join(indicators[:3])}。")
-            
-            # Trend analysis
-            if len(results) > 1 and years:
-                response_parts.append("从时间维度看，数据呈现一定的变化趋势。")
-            
-            # Suggestions
-            response_parts.append("建议您查看具体数据详情以获取更准确的信息。")
-        else:
-            response_parts.append(f"I found {len(results)} relevant data records.")
-            
-            if companies:
-                response_parts.append(f"Companies involved include: {', '.join(companies[:3])}.")
-            
-            if years:
-                response_parts.append(f"Data year range: {min(years)}-{max(years)}.")
-            
-            if indicators:
-                response_parts.append(f"Main indicators include: {', '.join(indicators[:3])}.")
-            
-            # Trend analysis
-            if len(results) > 1 and years:
-                response_parts.append("From a temporal perspective, the data shows certain trends.")
-            
-            # Suggestions
-            response_parts.append("I recommend reviewing specific data details for more accurate information.")
+        # Suggestions
+        response_parts.append(suggestion)
         
         return " ".join(response_parts)
     
@@ -958,295 +1602,403 @@ class FixedMemoRAG:
         else:
             print(f"❌ {self.t('no_llm_api')}")
     
-    def _execute_query_with_post_filter(self, query_analysis: Dict, collection_name: str, n_results: int) -> List[Dict[str, Any]]:
+    def toggle_debug_mode(self):
+        """Toggle debug mode"""
+        self.debug_mode = not self.debug_mode
+        status = self.t('debug_mode_on') if self.debug_mode else self.t('debug_mode_off')
+        print(f"🔍 {status}")
+    
+    def _execute_query_with_post_filter(self, query_analysis: Dict, collection_name: str, n_results: int,
+                                        query_embedding: np.ndarray = None) -> List[Dict[str, Any]]:
         """执行查询并进行后过滤"""
         try:
             collection = self.client.get_collection(name=collection_name)
-            query_embedding = self.model.encode([query_analysis['optimized_query']])[0].tolist()
-            
-            # 先执行基础查询，获取更多结果
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=min(50, n_results * 5),  # 获取更多结果用于过滤
-                include=['documents', 'metadatas', 'distances']
-            )
+            if query_embedding is None:
+                query_embedding = self.encode_queries([query_analysis['optimized_query']])[0]
             
-            # 处理结果
-            processed_results = []
-            for i in range(len(results['documents'][0])):
-                document = results['documents'][0][i]
-                metadata = results['metadatas'][0][i]
-                distance = results['distances'][0][i]
-                similarity = 1 - distance
+            # 无过滤条件时只取 n_results；有过滤条件时先多取，过滤后不足再扩大检索范围
+            extracted_info = query_analysis['extracted_info']
+            has_filters = bool(extracted_info['years'] or extracted_info['companies'] or extracted_info['indicator_codes'])
+            k = min(50, n_results * 5) if has_filters else n_results
+            # 精确条件（年份、指标代码、股票代码）下推到检索阶段
+            where = self._build_where(extracted_info)
+            while True:
+                results = self._search(collection, query_embedding, k, where)
+                if where is not None and len(results['documents'][0]) < k:
+                    # 精确条件（$and）命中不足 k 条：并入无条件检索结果，
+                    # 只满足部分条件的近似结果（如同公司其他年份）仍由后过滤计分排序
+                    results = self._merge_search_results(results, self._search(collection, query_embedding, k))
+                processed_results = self._process_search_results(results)
                 
-                esg_info = self.extract_esg_info(document)
-                
-                result = {
-                    'document': document,
-                    'metadata': metadata,
-                    'distance': distance,
-                    'similarity': similarity,
-                    'esg_info': esg_info
-                }
-                
-                processed_results.append(result)
+                # 后过滤（传入副本，保留检索顺序用于下方展示）
+                filtered_results = self._post_filter_results(list(processed_results), query_analysis)
+                if (not has_filters or len(filtered_results) >= n_results
+                        or len(processed_results) < k or k >= _MAX_OVERFETCH):
+                    break
+                k = min(k * 2, _MAX_OVERFETCH)
             
             # Debug: display all searched companies
             print(f"\n🔍 {self.t('searched_companies')} ({len(processed_results)} records):")
-            companies_found = set()
-            for i, r in enumerate(processed_results[:10]):
-                esg_info = r['esg_info']
-                metadata = r['metadata']
-                company = esg_info.get('company', metadata.get('company', 'N/A'))
-                companies_found.add(company)
-                print(f"   {i+1}. {company} ({self.t('similarity')}: {r['similarity']:.3f})")
-                
+            similarity_label = self.t('similarity')
+            shown = processed_results[:10]
+            shown_companies = [r['esg_info'].get('company', r['metadata'].get('company', 'N/A')) for r in shown]
+            companies_found = set(shown_companies)
+            if not self.debug_mode:
+                if shown:
+                    print("\n".join(f"   {i}. {company} ({similarity_label}: {r['similarity']:.3f})"
+                                    for i, (r, company) in enumerate(zip(shown, shown_companies), 1)))
+            else:
                 # Debug: display original document and metadata
-                if self.debug_mode:
-                    print(f"      📄 {self.t('original_document')}: {r['document'][:100]}...")
-                    print(f"      📋 {self.t('metadata')}: {metadata}")
-                    print(f"      🔍 {self.t('extraction_result')}: {esg_info}")
+                document_label = self.t('original_document')
+                metadata_label = self.t('metadata')
+                extraction_label = self.t('extraction_result')
+                for i, (r, company) in enumerate(zip(shown, shown_companies), 1):
+                    print(f"   {i}. {company} ({similarity_label}: {r['similarity']:.3f})")
+                    print(f"      📄 {document_label}: {r['document'][:100]}...")
+                    print(f"      📋 {metadata_label}: {r['metadata']}")
+                    print(f"      🔍 {extraction_label}: {r['esg_info']}")
                     print()
             
             print(f"\n📊 {self.t('unique_companies_found')}: {list(companies_found)}")
             
-            # 后过滤
-            filtered_results = self._post_filter_results(processed_results, query_analysis)
-            
-            # 按相似度排序
-            filtered_results.sort(key=lambda x: x['similarity'], reverse=True)
-            
-            return filtered_results[:n_results]
+            # 按相似度排序（稳定排序，同相似度保持重排序顺序），只取前 n_results
+            similarities = np.fromiter((r['similarity'] for r in filtered_results), dtype=np.float64,
+                                       count=len(filtered_results))
+            return [filtered_results[i] for i in np.argsort(-similarities, kind='stable')[:n_results]]
             
         except Exception as e:
             print(f"Query error: {str(e)}")
             return []
     
-    def _post_filter_results(self, results: List[Dict], query_analysis: Dict) -> List[Dict]:
-        """后过滤结果并进行智能重排序"""
-        extracted_info = query_analysis['extracted_info']
-        
-        # 如果没有提取到任何过滤条件，直接返回原始结果
-        if not extracted_info['years'] and not extracted_info['companies'] and not extracted_info['indicator_codes']:
-            return self._rerank_results(results, query_analysis)
+    def _process_search_results(self, results: Dict[str, List]) -> List[Dict[str, Any]]:
+        """Turn raw search hits into result rows (extracted ESG info, validity and match keys)"""
+        # 处理结果（相似度一次向量化计算）
+        distances = np.asarray(results['distances'][0], dtype=np.float64)
+        similarities = 1.0 - distances
+        processed_results = []
+        for document, metadata, distance, similarity in zip(results['documents'][0], results['metadatas'][0],
+                                                             distances.tolist(), similarities.tolist()):
+            metadata = _intern_metadata(metadata)
+            esg_info = self.extract_esg_info(document)
+            
+            result = {
+                'document': document,
+                'metadata': metadata,
+                'distance': distance,
+                'similarity': similarity,
+                'esg_info': esg_info,
+                'is_valid': _is_valid_value(esg_info.get('value')),
+                # Normalized match keys (metadata first, then extracted), built once for scoring
+                '_years': tuple(str(field) for field in (metadata.get('year'), esg_info.get('year')) if field),
+                '_companies': tuple(str(field).lower() for field in (metadata.get('company'), esg_info.get('company')) if field),
+                '_codes': tuple(str(field).upper() for field in (metadata.get('field_code'), esg_info.get('code')) if field)
+            }
+            
+            processed_results.append(result)
         
-        # 计算每个结果的匹配分数
-        scored_results = []
+        return processed_results
+    
+    @staticmethod
+    def _build_where(extracted_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Chroma where clause for the exact-match filters (years, indicator codes, tickers)"""
+        clauses = []
+        years = sorted({int(year) for year in extracted_info['years'] if str(year).isdigit()})
+        if years:
+            clauses.append({'year': {'$in': years}})
+        # Partial codes (e.g. "ES04") are prefix matches, which only the post-filter can express
+        codes = sorted({code.upper() for code in extracted_info['indicator_codes']})
+        full_codes = [code for code in codes if _FULL_CODE_RE.fullmatch(code)]
+        if full_codes and all(any(full.startswith(code) for full in full_codes) for code in codes):
+            clauses.append({'field_code': {'$in': full_codes}})
+        tickers = sorted({
+            f"{match.group(1).upper()} US Equity"
+            for match in (_TICKER_RE.fullmatch(company.strip()) for company in extracted_info['companies'])
+            if match
+        })
+        if tickers:
+            clauses.append({'ticker': {'$in': tickers}})
+        
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {'$and': clauses}
+    
+    def _where_mask(self, index: Dict[str, Any], where: Dict[str, Any]) -> np.ndarray:
+        """Boolean row mask for a where clause over the local index metadata ($and / $in / $eq)"""
+        if '$and' in where:
+            mask = np.ones(len(index['metadatas']), dtype=bool)
+            for clause in where['$and']:
+                mask &= self._where_mask(index, clause)
+            return mask
+        
+        (field, condition), = where.items()
+        # Metadata columns are materialized once per field and reused across queries
+        columns = index.setdefault('columns', {})
+        if field not in columns:
+            columns[field] = np.array([metadata.get(field) if metadata else None
+                                       for metadata in index['metadatas']], dtype=object)
+        column = columns[field]
+        
+        if isinstance(condition, dict):
+            (op, value), = condition.items()
+            if op == '$in':
+                return np.isin(column, np.array(value, dtype=object))
+            if op == '$eq':
+                return column == value
+            raise ValueError(f"Unsupported where operator: {op}")
+        return column == condition
+    
+    @staticmethod
+    def _merge_search_results(*results: Dict[str, List]) -> Dict[str, List]:
+        """Union of several search results (deduplicated by document, closest distance first)"""
+        hits = {}
         for result in results:
-            score = self._calculate_match_score(result, extracted_info)
-            if score > 0:  # 只保留有匹配的结果
-                result['match_score'] = score
-                scored_results.append(result)
-        
-        # 如果没有匹配的结果，返回原始结果
-        if not scored_results:
-            return self._rerank_results(results, query_analysis)
+            for document, metadata, distance in zip(result['documents'][0], result['metadatas'][0],
+                                                    result['distances'][0]):
+                if document not in hits or distance < hits[document][1]:
+                    hits[document] = (metadata, distance)
+        ordered = sorted(hits.items(), key=lambda item: item[1][1])
+        return {
+            'documents': [[document for document, _ in ordered]],
+            'metadatas': [[metadata for _, (metadata, _) in ordered]],
+            'distances': [[distance for _, (_, distance) in ordered]]
+        }
+    
+    def _search(self, collection, query_embedding: np.ndarray, k: int,
+                where: Optional[Dict[str, Any]] = None) -> Dict[str, List]:
+        """Top-k cosine search, optionally restricted by a metadata where clause; returns the same shape as collection.query"""
+        index = self._get_local_index(collection) if self.local_index else None
+        
+        if index is None:
+            query_kwargs = {'where': where} if where is not None else {}
+            return collection.query(
+                query_embeddings=[np.asarray(query_embedding).tolist()],
+                n_results=k,
+                include=['documents', 'metadatas', 'distances'],
+                **query_kwargs
+            )
         
-        # 智能重排序
-        reranked_results = self._rerank_results(scored_results, query_analysis)
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        query_vec = query_vec / (np.linalg.norm(query_vec) or 1.0)  # not in place: may be a cached embedding
+        candidates = np.flatnonzero(self._where_mask(index, where)) if where is not None else None
+        k = min(k, len(index['documents']) if candidates is None else len(candidates))
+        
+        if k == 0:
+            scores, top = np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        elif 'faiss' in index and candidates is not None and len(candidates) <= _EXACT_FILTER_ROWS:
+            # Small filtered subsets are scored exactly; graph search under a selective filter can miss rows
+            subset_scores = index['faiss'].reconstruct_batch(candidates.astype(np.int64)) @ query_vec
+            top = np.argsort(-subset_scores)[:k]
+            scores, top = subset_scores[top], candidates[top]
+        elif 'faiss' in index:
+            search_kwargs = {}
+            if candidates is not None:
+                selector = faiss.IDSelectorBatch(candidates.astype(np.int64))
+                if hasattr(index['faiss'], 'hnsw'):
+                    search_kwargs['params'] = faiss.SearchParametersHNSW(sel=selector, efSearch=index['faiss'].hnsw.efSearch)
+                else:
+                    search_kwargs['params'] = faiss.SearchParameters(sel=selector)
+            scores, top = index['faiss'].search(query_vec[np.newaxis, :], k, **search_kwargs)
+            valid = top[0] >= 0
+            scores, top = scores[0][valid], top[0][valid]
+        else:
+            # One matrix-vector product scores every row; argpartition selects top-k in O(N)
+            all_scores = self._score_rows(index, query_vec)
+            if candidates is not None:
+                all_scores = all_scores[candidates]
+            top = np.argpartition(all_scores, -k)[-k:]
+            top = top[np.argsort(-all_scores[top])]
+            scores = all_scores[top]
+            if candidates is not None:
+                top = candidates[top]
         
-        return reranked_results
+        return {
+            'documents': [[index['documents'][i] for i in top]],
+            'metadatas': [[index['metadatas'][i] for i in top]],
+            'distances': [(1.0 - scores).tolist()]
+        }
     
-    def _calculate_match_score(self, result: Dict, extracted_info: Dict) -> int:
-        """计算匹配分数"""
-        metadata = result['metadata']
-        esg_info = result['esg_info']
-        score = 0
-        
-        # 年份匹配分数
-        if extracted_info['years']:
-            for year in extracted_info['years']:
-                if metadata.get('year') and str(metadata.get('year')) == str(year):
-                    score += 10
-                elif esg_info.get('year') and str(esg_info.get('year')) == str(year):
-                    score += 10
+    def _score_rows(self, index: Dict[str, Any], query_vec: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        """Cosine score of every indexed row against a normalized query"""
+        if 'matrix' in index:
+            return index['matrix'] @ query_vec
+        
+        # int8 rows are widened one cache-sized block at a time, so DRAM traffic stays int8
+        quantized, scales = index['quantized'], index['scales']
+        scores = np.empty(len(quantized), dtype=np.float32)
+        for start in range(0, len(quantized), block_size):
+            block = quantized[start:start + block_size]
+            scores[start:start + block_size] = block.astype(np.float32) @ query_vec
+        scores *= scales
+        return scores
+    
+    def _get_local_index(self, collection) -> Optional[Dict[str, Any]]:
+        """Load a collection's embeddings into a normalized float32 matrix (reloaded when its row count changes)"""
+        try:
+            count = collection.count()
+        except Exception:
+            count = None
+        cached = self._local_indexes.get(collection.name)
+        if cached is not None and cached[0] == count:
+            return cached[1]
+        
+        index = None
+        if count is None or count > self.local_index_max_rows:
+            # Too large (or unknown size) to snapshot into process memory
+            self._local_indexes[collection.name] = (count, None)
+            return None
         
-        # 公司匹配分数（更灵活的匹配）
-        if extracted_info['companies']:
-            for company in extracted_info['companies']:
-                # 检查metadata中的company字段
-                if metadata.get('company'):
-                    metadata_company = str(metadata.get('company')).lower()
-                    if company.lower() in metadata_company:
-                        score += 10
-                    # 特殊处理：如果查询的是"A US Equity"，也匹配包含"Agilent"的记录
-                    elif company.lower() == 'a us equity' and 'agilent' in metadata_company:
-                        score += 10
+        try:
+            data = collection.get(include=['embeddings', 'documents', 'metadatas'])
+            if data['embeddings'] is not None and len(data['embeddings']):
+                matrix = np.asarray(data['embeddings'], dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                matrix /= norms
+                index = {
+                    'documents': data['documents'],
+                    'metadatas': [_intern_metadata(metadata) for metadata in data['metadatas']]
+                }
                 
-                # 检查esg_info中的company字段
-                if esg_info.get('company'):
-                    esg_company = str(esg_info.get('company')).lower()
-                    if company.lower() in esg_company:
-                        score += 10
-                    # 特殊处理：如果查询的是"A US Equity"，也匹配包含"Agilent"的记录
-                    elif company.lower() == 'a us equity' and 'agilent' in esg_company:
-                        score += 10
-        
-        # 指标代码匹配分数
-        if extracted_info['indicator_codes']:
-            for code in extracted_info['indicator_codes']:
-                if metadata.get('field_code') and code.upper() in str(metadata.get('field_code')).upper():
-                    score += 10
-                elif esg_info.get('code') and code.upper() in str(esg_info.get('code')).upper():
-                    score += 10
+                if self.ann_index and FAISS_AVAILABLE:
+                    if self.quantize_index:
+                        hnsw_index = faiss.IndexHNSWSQ(matrix.shape[1], faiss.ScalarQuantizer.QT_8bit, 32,
+                                                       faiss.METRIC_INNER_PRODUCT)
+                        hnsw_index.train(matrix)
+                    else:
+                        hnsw_index = faiss.IndexHNSWFlat(matrix.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+                    hnsw_index.hnsw.efConstruction = 200
+                    hnsw_index.hnsw.efSearch = 64
+                    hnsw_index.add(matrix)
+                    index['faiss'] = hnsw_index
+                elif not self.quantize_index:
+                    index['matrix'] = matrix
+                elif FAISS_AVAILABLE:
+                    sq_index = faiss.IndexScalarQuantizer(matrix.shape[1], faiss.ScalarQuantizer.QT_8bit,
+                                                          faiss.METRIC_INNER_PRODUCT)
+                    sq_index.train(matrix)
+                    sq_index.add(matrix)
+                    index['faiss'] = sq_index
+                else:
+                    scales = np.abs(matrix).max(axis=1) / 127.0
+                    scales[scales == 0] = 1.0
+                    index['quantized'] = np.round(matrix / scales[:, np.newaxis]).astype(np.int8)
+                    index['scales'] = scales.astype(np.float32)
+        except Exception as e:
+            print(f"⚠️ Failed to load local index for {collection.name}, using Chroma query: {str(e)}")
         
-        return score
+        self._local_indexes[collection.name] = (count, index)
+        return index
     
-    def _rerank_results(self, results: List[Dict], query_analysis: Dict) -> List[Dict]:
-        """智能重排序结果"""
+    def _post_filter_results(self, results: List[Dict], query_analysis: Dict) -> List[Dict]:
+        """后过滤结果并进行智能重排序（匹配分数与重排序分数一次遍历计算）"""
         extracted_info = query_analysis['extracted_info']
+        has_criteria = bool(extracted_info['years'] or extracted_info['companies'] or extracted_info['indicator_codes'])
+        
+        # 查询条件只归一化一次
+        years = [str(year) for year in extracted_info['years']]
+        # Each queried company matches itself or any of its ticker aliases
+        company_terms = [
+            (company_lc,) + TICKER_ALIASES.get(company_lc, ())
+            for company_lc in (company.lower() for company in extracted_info['companies'])
+        ]
+        codes = [code.upper() for code in extracted_info['indicator_codes']]
         
-        # 为每个结果计算重排序分数
+        scored = []
         for result in results:
-            score = 0
-            esg_info = result['esg_info']
-            metadata = result['metadata']
-            
-            # 1. 数据完整性分数（最重要）
-            value = esg_info.get('value', '')
-            if value and str(value).lower() != 'nan' and str(value).strip():
-                score += 100  # 有效数据高分
-            else:
-                score -= 20  # 无效数据轻微扣分（不要完全排除）
-            
-            # 2. 匹配分数（如果有的话）
-            if 'match_score' in result:
-                score += result['match_score'] * 5
-            
-            # 3. 年份匹配分数
-            if extracted_info['years']:
-                for year in extracted_info['years']:
-                    if metadata.get('year') and str(metadata.get('year')) == str(year):
-                        score += 50
-                    elif esg_info.get('year') and str(esg_info.get('year')) == str(year):
-                        score += 50
-            
-            # 4. 公司匹配分数（更灵活的匹配）
-            if extracted_info['companies']:
-                for company in extracted_info['companies']:
-                    # 检查metadata中的company字段
-                    if metadata.get('company'):
-                        metadata_company = str(metadata.get('company')).lower()
-                        if company.lower() in metadata_company:
-                            score += 30
-                        # 特殊处理：如果查询的是"A US Equity"，也匹配包含"Agilent"的记录
-                        elif company.lower() == 'a us equity' and 'agilent' in metadata_company:
-                            score += 30
-                    
-                    # 检查esg_info中的company字段
-                    if esg_info.get('company'):
-                        esg_company = str(esg_info.get('company')).lower()
-                        if company.lower() in esg_company:
-                            score += 30
-                        # 特殊处理：如果查询的是"A US Equity"，也匹配包含"Agilent"的记录
-                        elif company.lower() == 'a us equity' and 'agilent' in esg_company:
-                            score += 30
-            
-            # 5. 指标代码匹配分数
-            if extracted_info['indicator_codes']:
-                for code in extracted_info['indicator_codes']:
-                    if metadata.get('field_code') and code.upper() in str(metadata.get('field_code')).upper():
-                        score += 20
-                    elif esg_info.get('code') and code.upper() in str(esg_info.get('code')).upper():
-                        score += 20
+            # 年份匹配（metadata或esg_info任一匹配即计分）
+            result_years = result['_years']
+            year_hits = sum(1 for year in years if year in result_years)
             
-            # 6. 相似度分数
-            score += result.get('similarity', 0) * 10
+            # 公司匹配（更灵活的匹配，metadata与esg_info分别计分）
+            company_hits = 0
+            for terms in company_terms:
+                for candidate in result['_companies']:
+                    if any(term in candidate for term in terms):
+                        company_hits += 1
             
-            # 7. ESG类别匹配分数
-            if extracted_info['esg_categories']:
-                score += 10
+            # 指标代码匹配（metadata或esg_info任一匹配即计分）
+            result_codes = result['_codes']
+            code_hits = sum(1 for code in codes if any(code in candidate for candidate in result_codes))
             
+            match_score = 10 * (year_hits + company_hits + code_hits)
+            # 数据完整性分数（最重要）：有效数据高分，无效数据轻微扣分（不要完全排除）
+            base_score = (100 if result['is_valid'] else -20) + 50 * year_hits + 30 * company_hits + 20 * code_hits
+            scored.append((result, match_score, base_score))
+        
+        # 只保留有匹配的结果；没有过滤条件或没有匹配的结果时保留全部
+        matched = [item for item in scored if item[1] > 0] if has_criteria else []
+        if matched:
+            scored = matched
+            results = [result for result, _, _ in matched]
+            for result, match_score, _ in matched:
+                result['match_score'] = match_score
+        
+        # 重排序分数按列（数组）计算：基础分 + 匹配分数（如果有的话）+ 相似度分数 + ESG类别匹配分数
+        count = len(scored)
+        base_scores = np.fromiter((base_score for _, _, base_score in scored), dtype=np.float64, count=count)
+        # 匹配分数只在有匹配结果时计入（已在上面一次计算，不再从结果字典回读）
+        if matched:
+            match_bonus = np.fromiter((match_score * 5 for _, match_score, _ in scored), dtype=np.float64, count=count)
+        else:
+            match_bonus = 0.0
+        similarities = np.fromiter((result.get('similarity', 0) for result, _, _ in scored),
+                                   dtype=np.float64, count=count)
+        rerank_scores = (base_scores + match_bonus) + similarities * 10
+        if extracted_info['esg_categories']:
+            rerank_scores += 10
+        for (result, _, _), score in zip(scored, rerank_scores.tolist()):
             result['rerank_score'] = score
         
-        # 按重排序分数排序
-        results.sort(key=lambda x: x['rerank_score'], reverse=True)
-        
-        return results
+        # 按重排序分数排序（稳定排序，同分保持原顺序）
+        return [results[i] for i in np.argsort(-rerank_scores, kind='stable')]
     
     def extract_esg_info(self, document: str) -> Dict[str, str]:
         """从文档中提取ESG信息"""
         info = {}
+        debug_mode = getattr(self, 'debug_mode', False)
         
         try:
             # Debug: print original document
-            if hasattr(self, 'debug_mode') and self.debug_mode:
+            if debug_mode:
                 print(f"🔍 {self.t('original_document')}: {document[:200]}...")
             
             # Extract company name - support multiple formats
-            company_patterns = [
-                r'([^（]+)（',  # Chinese format: company name（
-                r'([A-Za-z\s]+(?:Inc|Corp|Ltd|Company|Technologies|Systems|Group|Holdings))',  # English format
-                r'([A-Z]{1,6}\s+US\s+Equity)',  # Ticker format
-            ]
-            
-            for pattern in company_patterns:
-                company_match = re.search(pattern, document)
+            for pattern in _DOC_COMPANY_PATTERNS:
+                company_match = pattern.search(document)
                 if company_match:
-                    info['company'] = company_match.group(1).strip()
+                    info['company'] = sys.intern(company_match.group(1).strip())
                     break
             
             # Extract year - support multiple formats
-            year_patterns = [
-                r'在(\d{4})年',  # Chinese format: 在2006年
-                r'(\d{4})',      # Simple number format
-                r'year\s+(\d{4})',  # year 2006
-                r'in\s+(\d{4})',   # in 2006
-            ]
-            
-            for pattern in year_patterns:
-                year_match = re.search(pattern, document, re.IGNORECASE)
+            for pattern in _DOC_YEAR_PATTERNS:
+                year_match = pattern.search(document)
                 if year_match:
                     info['year'] = year_match.group(1)
                     break
             
             # 提取指标名 - 支持多种格式
-            indicator_patterns = [
-                r'：([^（]+)（',  # 中文格式：指标名（
-                r'([A-Za-z\s]+(?:Emissions|Consumption|Policy|Rights|Workforce|Diversity|Governance))',  # 英文指标
-                r'(nitrogen\s+oxide\s+emissions?)',  # 具体指标
-                r'(carbon\s+dioxide\s+emissions?)',
-                r'(methane\s+emissions?)',
-                r'(voc\s+emissions?)',
-                r'(women\s+workforce)',
-                r'(pct\s+women\s+in\s+workforce)',
-            ]
-            
-            for pattern in indicator_patterns:
-                indicator_match = re.search(pattern, document, re.IGNORECASE)
+            for pattern in _DOC_INDICATOR_PATTERNS:
+                indicator_match = pattern.search(document)
                 if indicator_match:
                     info['indicator'] = indicator_match.group(1).strip()
                     break
             
             # 提取指标代码
-            code_patterns = [
-                r'code=([^）]+)',  # code=ES001
-                r'(ES\d{3})',      # ES001
-                r'(ES\d{2})',     # ES01
-            ]
-            
-            for pattern in code_patterns:
-                code_match = re.search(pattern, document, re.IGNORECASE)
+            for pattern in _DOC_CODE_PATTERNS:
+                code_match = pattern.search(document)
                 if code_match:
                     info['code'] = code_match.group(1).strip()
                     break
             
             # 提取数值 - 支持多种格式
-            value_patterns = [
-                r'= ([^,]+)',     # = 42.6
-                r':\s*([^,\s]+)', # : 42.6
-                r'(\d+\.?\d*)',   # 简单数字
-                r'(True|False)',  # 布尔值
-            ]
-            
-            for pattern in value_patterns:
-                value_match = re.search(pattern, document)
+            for pattern in _DOC_VALUE_PATTERNS:
+                value_match = pattern.search(document)
                 if value_match:
                     info['value'] = value_match.group(1).strip()
                     break
             
             # Debug: print extraction results
-            if hasattr(self, 'debug_mode') and self.debug_mode:
+            if debug_mode:
                 print(f"🔍 {self.t('extraction_result')}: {info}")
             
         except Exception as e:
@@ -1280,52 +2032,140 @@ class FixedMemoRAG:
         # 基于年份分析
         years = [r['esg_info'].get('year') for r in results if r['esg_info'].get('year')]
         if years:
-            unique_years = sorted(list(set(years)))
-            insights.append(f"数据年份范围: {min(unique_years)}-{max(unique_years)}")
+            year_min, year_max = _min_max(years)
+            insights.append(f"数据年份范围: {year_min}-{year_max}")
         
         return insights
     
     def add_to_memory(self, query: str, results: List[Dict], insights: List[str] = None):
         """添加查询到记忆系统"""
+        # Collect summary fields in one pass over results
+        companies, years, indicators = set(), set(), set()
+        top_similarity = None
+        for r in results:
+            metadata = r.get('metadata', {})
+            companies.add(metadata.get('company', ''))
+            if metadata.get('year'):
+                years.add(metadata['year'])
+            indicators.add(metadata.get('field_name', ''))
+            similarity = r.get('similarity', 0)
+            if top_similarity is None or similarity > top_similarity:
+                top_similarity = similarity
+        
+        now = datetime.now()
         memory_entry = {
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': now.isoformat(),
+            'ts_epoch': now.timestamp(),
             'query': query,
             'result_count': len(results),
-            'top_similarity': max([r.get('similarity', 0) for r in results]) if results else 0,
+            'top_similarity': top_similarity if results else 0,
             'insights': insights or [],
-            'companies': list(set([r.get('metadata', {}).get('company', '') for r in results])),
-            'years': list(set([r.get('metadata', {}).get('year') for r in results if r.get('metadata', {}).get('year')])),
-            'indicators': list(set([r.get('metadata', {}).get('field_name', '') for r in results]))
+            'companies': list(companies),
+            'years': list(years),
+            'indicators': list(indicators)
         }
         
         self.memory['queries'].append(memory_entry)
+        self._count_memory_queries([memory_entry])
         
         # 保持记忆大小
         if len(self.memory['queries']) > self.memory_size:
+            self._count_memory_queries(self.memory['queries'][:-self.memory_size], -1)
             self.memory['queries'] = self.memory['queries'][-self.memory_size:]
         
-        # 保存记忆
-        self.save_memory()
+        # 追加写入日志（定期压缩到JSON快照）
+        self._append_memory_log(memory_entry)
+        if self._memory_log_entries >= self.memory_compact_every:
+            self.save_memory()
+    
+    def _count_memory_queries(self, queries: List[Dict[str, Any]], sign: int = 1):
+        """Add (sign=1) or remove (sign=-1) queries from the popularity counters"""
+        for counts, field in ((self._company_counts, 'companies'), (self._year_counts, 'years')):
+            for query in queries:
+                for value in query.get(field, ()):
+                    counts[value] += sign
+                    if counts[value] <= 0:
+                        del counts[value]
+    
+    def _reset_memory_counts(self):
+        """Rebuild the popularity counters from the retained queries"""
+        self._company_counts = Counter()
+        self._year_counts = Counter()
+        self._count_memory_queries(self.memory['queries'])
+    
+    def _append_memory_log(self, memory_entry: Dict[str, Any]):
+        """Append one memory entry to the JSONL log"""
+        try:
+            if self._memory_log is None:
+                log_file = os.path.join(self.db_path, 'memorag_memory.jsonl')
+                self._memory_log = open(log_file, 'a', encoding='utf-8', buffering=1)  # line-buffered
+            self._memory_log.write(_json_dumps(memory_entry, default=str).decode('utf-8') + "\n")
+            self._memory_log_entries += 1
+        except Exception as e:
+            print(f"Failed to append memory log: {str(e)}")
+            self.save_memory()
+    
+    def _compact_memory(self):
+        """Fold pending log entries into the memory snapshot"""
+        if self._memory_log_entries:
+            self.save_memory()
     
     def save_memory(self):
-        """保存记忆到文件"""
-        memory_file = os.path.join(self.db_path, 'memorag_memory.pkl')
+        """保存记忆到文件（并清空追加日志）"""
+        memory_file = os.path.join(self.db_path, 'memorag_memory.json')
         try:
             with open(memory_file, 'wb') as f:
-                pickle.dump(self.memory, f)
+                f.write(_json_dumps(self.memory, default=str))
         except Exception as e:
             print(f"Failed to save memory: {str(e)}")
+            return
+        
+        # Snapshot now holds every entry; truncate the log
+        if self._memory_log is not None:
+            self._memory_log.close()
+            self._memory_log = None
+        log_file = os.path.join(self.db_path, 'memorag_memory.jsonl')
+        if os.path.exists(log_file):
+            os.remove(log_file)
+        self._memory_log_entries = 0
     
     def load_memory(self):
         """从文件加载记忆"""
-        memory_file = os.path.join(self.db_path, 'memorag_memory.pkl')
+        memory_file = os.path.join(self.db_path, 'memorag_memory.json')
+        legacy_file = os.path.join(self.db_path, 'memorag_memory.pkl')
+        loaded = False
         if os.path.exists(memory_file):
             try:
                 with open(memory_file, 'rb') as f:
+                    self.memory = _json_loads(f.read())
+                loaded = True
+            except Exception as e:
+                print(f"Failed to load memory: {str(e)}")
+        elif os.path.exists(legacy_file):
+            # 兼容旧版pickle记忆文件，下次保存时转为JSON
+            try:
+                with open(legacy_file, 'rb') as f:
                     self.memory = pickle.load(f)
-                print(f"✅ {self.t('memory_loaded')}, contains {len(self.memory['queries'])} historical queries")
+                loaded = True
             except Exception as e:
                 print(f"Failed to load memory: {str(e)}")
+        
+        # Replay entries appended since the last compaction
+        log_file = os.path.join(self.db_path, 'memorag_memory.jsonl')
+        if os.path.exists(log_file):
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            self.memory['queries'].append(_json_loads(line))
+                            self._memory_log_entries += 1
+            except Exception as e:
+                print(f"Failed to replay memory log: {str(e)}")
+            self.memory['queries'] = self.memory['queries'][-self.memory_size:]
+        self._reset_memory_counts()
+        
+        if loaded or self._memory_log_entries:
+            print(f"✅ {self.t('memory_loaded')}, contains {len(self.memory['queries'])} historical queries")
         else:
             print(f"📝 {self.t('new_memory')}")
     
@@ -1349,7 +2189,7 @@ class FixedMemoRAG:
                 esg_info = r['esg_info']
                 rerank_score = r.get('rerank_score', 0)
                 value = esg_info.get('value', 'N/A')
-                value_status = "✅" if value and str(value).lower() != 'nan' and str(value).strip() else "❌"
+                value_status = "✅" if r['is_valid'] else "❌"
                 print(f"   {i}. {value_status} {esg_info.get('company', 'N/A')} ({esg_info.get('year', 'N/A')}) - {esg_info.get('indicator', 'N/A')}: {value} [{self.t('quality_score')}:{rerank_score:.1f}]")
             
             if len(results) > 5:
@@ -1419,27 +2259,25 @@ class FixedMemoRAG:
         
         # Statistics
         total_queries = len(self.memory['queries'])
-        recent_queries = [q for q in self.memory['queries'] if 
-                         (datetime.now() - datetime.fromisoformat(q['timestamp'])).days < 7]
-        
-        # Popular companies
-        all_companies = []
-        for query in self.memory['queries']:
-            all_companies.extend(query['companies'])
-        company_counts = pd.Series(all_companies).value_counts()
+        # Queries are appended in time order: count back from the newest until the 7-day cutoff.
+        # Entries saved before ts_epoch existed fall back to parsing the ISO timestamp
+        cutoff = time.time() - 7 * 86400
+        recent_count = 0
+        for q in reversed(self.memory['queries']):
+            if (q['ts_epoch'] if 'ts_epoch' in q else datetime.fromisoformat(q['timestamp']).timestamp()) <= cutoff:
+                break
+            recent_count += 1
         
-        # Popular years
-        all_years = []
-        for query in self.memory['queries']:
-            all_years.extend(query['years'])
-        year_counts = pd.Series(all_years).value_counts()
+        # Popular companies and years (maintained incrementally)
+        popular_companies = [company for company, _ in self._company_counts.most_common(5)]
+        popular_years = [year for year, _ in self._year_counts.most_common(5)]
         
         print(f"\n📊 {self.t('memory_report')}:")
         print("=" * 50)
         print(f"{self.t('total_queries')}: {total_queries}")
-        print(f"{self.t('recent_queries')}: {len(recent_queries)}")
-        print(f"{self.t('popular_companies')}: {', '.join(company_counts.head(5).index.tolist())}")
-        print(f"{self.t('popular_years')}: {', '.join(map(str, year_counts.head(5).index.tolist()))}")
+        print(f"{self.t('recent_queries')}: {recent_count}")
+        print(f"{self.t('popular_companies')}: {', '.join(popular_companies)}")
+        print(f"{self.t('popular_years')}: {', '.join(map(str, popular_years))}")
         print(f"{self.t('pattern_count')}: {len(self.memory['patterns'])}")
         print(f"{self.t('trend_count')}: {len(self.memory['trends'])}")
     
@@ -1453,6 +2291,7 @@ class FixedMemoRAG:
             'trends': {},
             'last_update': None
         }
+        self._reset_memory_counts()
         self.save_memory()
         print(f"\n🗑️ {self.t('memory_cleared')}")
     
@@ -1464,37 +2303,39 @@ class FixedMemoRAG:
         print(f"💡 {self.t('quit')} to exit system")
         print("=" * 60)
         
+        # Strings used on every loop iteration, resolved once
+        query_prompt = f"\n🔍 {self.t('enter_query_prompt')}: "
+        goodbye = self.t('goodbye')
+        invalid_query = f"❌ {self.t('invalid_query')}"
+        
+        # Command aliases (English/Chinese) -> handler
+        quit_commands = {'quit', 'exit', '退出'}
+        commands = {}
+        for aliases, handler in ((('help', '帮助'), self.show_help),
+                                 (('collections', '集合'), self.show_collections),
+                                 (('memory', '记忆'), self.show_memory_report),
+                                 (('clear', '清空'), self.clear_memory),
+                                 (('mode', '模式'), self.toggle_llm_mode),
+                                 (('debug', '调试'), self.toggle_debug_mode)):
+            for alias in aliases:
+                commands[alias] = handler
+        
         while True:
             try:
                 # Get user input
-                user_input = input(f"\n🔍 {self.t('enter_query_prompt')}: ").strip()
+                user_input = input(query_prompt).strip()
                 
                 # Handle special commands
-                if user_input.lower() in ['quit', 'exit', '退出']:
-                    print(f"\n👋 {self.t('goodbye')}")
+                command = user_input.lower()
+                if command in quit_commands:
+                    print(f"\n👋 {goodbye}")
                     break
-                elif user_input.lower() in ['help', '帮助']:
-                    self.show_help()
-                    continue
-                elif user_input.lower() in ['collections', '集合']:
-                    self.show_collections()
-                    continue
-                elif user_input.lower() in ['memory', '记忆']:
-                    self.show_memory_report()
-                    continue
-                elif user_input.lower() in ['clear', '清空']:
-                    self.clear_memory()
-                    continue
-                elif user_input.lower() in ['mode', '模式']:
-                    self.toggle_llm_mode()
-                    continue
-                elif user_input.lower() in ['debug', '调试']:
-                    self.debug_mode = not self.debug_mode
-                    status = self.t('debug_mode_on') if self.debug_mode else self.t('debug_mode_off')
-                    print(f"🔍 {status}")
+                handler = commands.get(command)
+                if handler is not None:
+                    handler()
                     continue
                 elif not user_input:
-                    print(f"❌ {self.t('invalid_query')}")
+                    print(invalid_query)
                     continue
                 
                 # Execute query
@@ -1502,11 +2343,13 @@ class FixedMemoRAG:
                 self.display_results(result)
                 
             except KeyboardInterrupt:
-                print(f"\n\n👋 {self.t('goodbye')}")
+                print(f"\n\n👋 {goodbye}")
                 break
             except Exception as e:
                 print(f"\n❌ {self.t('processing_error')}: {str(e)}")
                 print(f"💡 {self.t('try_again')}")
+        
+        self.save_embedding_cache()
 
 def main():
     """Main function - Smart Interactive MemoRAG"""
@@ -1548,10 +2391,9 @@ def main():
             llm_api_key = None
     
     # Initialize system
-    memorag = FixedMemoRAG(db_path, llm_api_key=llm_api_key, language=language)
-    
-    # Start interactive mode
-    memorag.interactive_mode()
+    with FixedMemoRAG(db_path, llm_api_key=llm_api_key, language=language) as memorag:
+        # Start interactive mode
+        memorag.interactive_mode()
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
-import os, pyodbc, pandas as pd
+import os, functools, pyodbc, torch, pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
 import chromadb
 
@@ -8,6 +9,7 @@ MAX_ROWS = int(os.environ.get("ESG_EMBED_MAX", "5000"))
 FILTER_TICKER = os.environ.get("ESG_FILTER_TICKER")      
 FILTER_YEAR = os.environ.get("ESG_FILTER_YEAR")          
 MODEL_NAME = os.environ.get("ESG_EMBED_MODEL", "intfloat/multilingual-e5-base")
+ENCODE_BATCH = int(os.environ.get("ESG_ENCODE_BATCH", "256"))
 
 FILTER_COMPLETE = os.environ.get("ESG_FILTER_COMPLETE", "0") == "1"
 COLLECTION_NAME = os.environ.get("ESG_COLLECTION", "esg")
@@ -49,47 +51,93 @@ WHERE {where_sql} AND (f.ticker + '|' + CAST(f.[year] AS varchar(10)) + '|' + d.
 ORDER BY f.ticker, f.[year], d.field_code
 """
 
-def make_text(r):
-    return f"passage: {r.company_name} ({r.ticker}) in {int(r.year)}: {r.field_name} (code={r.field_code}) = {r.val}"
+def make_texts(df):
+    """Vectorized passage text and document id for a page of rows"""
+    # map(str) renders missing cells as str(None)/str(nan), same as the former per-row f-string
+    ticker = df["ticker"].map(str)
+    year = df["year"].astype(int).astype(str)
+    field_code = df["field_code"].map(str)
+    text = ("passage: " + df["company_name"].map(str) + " (" + ticker + ") in " + year + ": "
+            + df["field_name"].map(str) + " (code=" + field_code + ") = " + df["val"].map(str))
+    ids = ticker + "_" + year + "_" + field_code
+    return text, ids
 
-# 模型与 Chroma
-model = SentenceTransformer(MODEL_NAME)
+# 模型与 Chroma（同一进程内重复调用时复用已加载的实例）
+@functools.lru_cache(maxsize=1)
+def get_model(name, device):
+    model = SentenceTransformer(name, device=device)
+    if device == "cuda":
+        model.half()  # FP16 on GPU; CPU stays FP32
+    return model.eval()
+
+@functools.lru_cache(maxsize=None)
+def get_client(path):
+    return chromadb.PersistentClient(path=path)
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+model = get_model(MODEL_NAME, DEVICE)
+print(f"Encoding on {DEVICE}, batch_size={ENCODE_BATCH}")
 persist_dir = os.path.join(os.path.dirname(__file__), "esg_chroma")
-client = chromadb.PersistentClient(path=persist_dir)
+client = get_client(persist_dir)
 coll = client.get_or_create_collection(name=COLLECTION_NAME, metadata={"hnsw:space": "cosine"})
 
-# 迭代写入
-inserted, last_key = 0, ""
-BATCH = 2048
-while inserted < limit:
-    n = min(BATCH, limit - inserted)
+def fetch_page(n, after_key):
+    """Read the next keyset page of at most n rows"""
     sql = sql_page_tpl.format(n=n, where_sql=where_sql)
-    df = pd.read_sql(sql, cn, params=params + [last_key])
-    if df.empty:
-        break
-    df = df.iloc[:n]
-    df["text"] = df.apply(make_text, axis=1)
-    df["id"] = df.apply(lambda r: f"{r.ticker}_{int(r.year)}_{r.field_code}", axis=1)
-    embs = model.encode(df["text"].tolist(), normalize_embeddings=True).tolist()
+    df = pd.read_sql(sql, cn, params=params + [after_key])
+    return df.iloc[:n]
+
+def add_page(df, embs, indexed):
+    """Write one encoded page to Chroma"""
+    # 元数据按列取出（tolist 得到原生 Python 值），逐行 zip 组装，不再构造 namedtuple
+    columns = (df[c].tolist() for c in ("ticker", "company_name", "year", "esg_bucket", "field_code",
+                                        "field_name", "val", "incomplete", "source_file"))
     coll.add(
         ids=df["id"].tolist(),
-        embeddings=embs,
+        embeddings=embs.tolist(),  # chromadb 0.5.7 及以前只接受 list 形式的 embeddings
         documents=df["text"].tolist(),
         metadatas=[{
-            "ticker": str(r.ticker).strip().strip("'\""),
-            "company": r.company_name,
-            "year": int(r.year),
-            "year_s": str(int(r.year)),
-            "bucket": r.esg_bucket or "",
-            "field_code": r.field_code,
-            "field_name": r.field_name,
-            "value": r.val,
-            "incomplete": bool(r.incomplete),
-            "source_file": r.source_file
-        } for r in df.itertuples(index=False)]
+            "ticker": str(ticker).strip().strip("'\""),
+            "company": company_name,
+            "year": int(year),
+            "year_s": str(int(year)),
+            "bucket": esg_bucket or "",
+            "field_code": field_code,
+            "field_name": field_name,
+            "value": val,
+            "incomplete": bool(incomplete),
+            "source_file": source_file
+        } for ticker, company_name, year, esg_bucket, field_code, field_name, val, incomplete, source_file
+          in zip(*columns)]
     )
-    inserted += len(df)
-    last_key = f"{df.iloc[-1].ticker}|{int(df.iloc[-1].year)}|{df.iloc[-1].field_code}"
-    print(f"indexed {inserted}/{limit}")
+    print(f"indexed {indexed}/{limit}")
+
+# 迭代写入：读取下一页（SQL）、编码当前页（模型）、写入上一页（Chroma）三者流水线并行
+# SQL 读取始终在同一个工作线程中进行，pyodbc 连接不会被并发使用
+inserted = 0
+BATCH = 2048
+with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+    next_page = reader.submit(fetch_page, min(BATCH, limit), "") if limit > 0 else None
+    pending_add = None
+    while next_page is not None:
+        df = next_page.result()
+        next_page = None
+        if df.empty:
+            break
+        inserted += len(df)
+        # keyset 分页：下一页的起点在当前页读到后即可确定，先发起读取再编码
+        if inserted < limit:
+            last_key = f"{df.iloc[-1].ticker}|{int(df.iloc[-1].year)}|{df.iloc[-1].field_code}"
+            next_page = reader.submit(fetch_page, min(BATCH, limit - inserted), last_key)
+        df["text"], df["id"] = make_texts(df)
+        with torch.inference_mode():
+            embs = model.encode(df["text"].tolist(), batch_size=ENCODE_BATCH, normalize_embeddings=True,
+                                convert_to_numpy=True, show_progress_bar=False).astype("float32")
+        # 上一页写入完成后再提交当前页，保持写入顺序并及时抛出写入错误
+        if pending_add is not None:
+            pending_add.result()
+        pending_add = writer.submit(add_page, df, embs, inserted)
+    if pending_add is not None:
+        pending_add.result()
 
 print("done, persisted at:", persist_dir)
\ No newline at end of file
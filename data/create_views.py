@@ -4,24 +4,26 @@ cn = pyodbc.connect(r"DRIVER={ODBC Driver 17 for SQL Server};SERVER=localhost;DA
 cur = cn.cursor()
 
 # 一行=公司×年份；将 ES 与 G（以及未来其它桶）合并到一个 JSON 列 ESG_json
+# 按主键 (ticker, year, field_code) 顺序一次扫描分组聚合：每行用 FOR JSON 生成对象（保留转义与 NULL 省略），
+# 再用 STRING_AGG 拼成数组（需要 SQL Server 2017+）
 cur.execute("""
 CREATE OR ALTER VIEW dbo.vw_company_year_esg_all AS
 SELECT
-  t.ticker,
+  f.ticker,
   c.company_name,
-  t.[year],
-  (
-    SELECT d.field_code,
-           bucket = d.esg_bucket,
-           field_name = d.field_name,
-           value = COALESCE(CAST(f.value_numeric AS varchar(100)), f.value_text)
-    FROM dbo.fact_observation f
-    JOIN dbo.dim_field d ON d.field_code = f.field_code
-    WHERE f.ticker = t.ticker AND f.[year] = t.[year]
-    FOR JSON PATH
-  ) AS ESG_json
-FROM (SELECT DISTINCT ticker,[year] FROM dbo.fact_observation) t
-JOIN dbo.dim_company c ON c.ticker = t.ticker;
+  f.[year],
+  '[' + STRING_AGG(CAST(j.obj AS nvarchar(max)), ',') WITHIN GROUP (ORDER BY f.field_code) + ']' AS ESG_json
+FROM dbo.fact_observation f
+JOIN dbo.dim_field d ON d.field_code = f.field_code
+JOIN dbo.dim_company c ON c.ticker = f.ticker
+CROSS APPLY (
+  SELECT d.field_code,
+         bucket = d.esg_bucket,
+         field_name = d.field_name,
+         value = COALESCE(CAST(f.value_numeric AS varchar(100)), f.value_text)
+  FOR JSON PATH, WITHOUT_ARRAY_WRAPPER
+) j(obj)
+GROUP BY f.ticker, c.company_name, f.[year];
 """)
 
 # 简
\ No newline at end of file
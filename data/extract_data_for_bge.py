@@ -8,8 +8,47 @@
 import os
 import pandas as pd
 import pyodbc
+from contextlib import ExitStack
 from datetime import datetime
 
+try:
+    import connectorx as cx
+    CONNECTORX_AVAILABLE = True
+except ImportError:
+    CONNECTORX_AVAILABLE = False
+
+# connectorx 连接串：事实表批次走原生（Arrow）解码，不经过逐行 Python 对象
+CX_CONN = os.environ.get("ESG_CX_CONN", "mssql://localhost:1433/ESG?trusted_connection=true")
+
+# 事实表批次的紧凑列类型：低基数字符串列用 category，年份用 int16
+FACT_DTYPES = {
+    'ticker': 'category',
+    'field_code': 'category',
+    'esg_bucket': 'category',
+    'company_name': 'category',
+    'year': 'int16',
+}
+
+def _sql_literal(value):
+    """keyset 参数渲染为 T-SQL 字面量（connectorx 不支持参数绑定）"""
+    if isinstance(value, str):
+        # ticker/field_code 为 varchar 列，用非 N 前缀字面量，避免隐式转换影响索引查找
+        return "'" + value.replace("'", "''") + "'"
+    return str(int(value))
+
+def read_fact_batch(sql, cn, params):
+    """读取一批事实数据：安装了 connectorx 时用它，失败或未安装时用 pyodbc"""
+    global CONNECTORX_AVAILABLE
+    if CONNECTORX_AVAILABLE:
+        parts = sql.split("?")
+        rendered = parts[0] + "".join(_sql_literal(p) + rest for p, rest in zip(params, parts[1:]))
+        try:
+            return cx.read_sql(CX_CONN, rendered, return_type="pandas")
+        except Exception as e:
+            print(f"   ⚠️ connectorx 读取失败，改用 pyodbc: {str(e)}")
+            CONNECTORX_AVAILABLE = False
+    return pd.read_sql(sql, cn, params=params)
+
 def extract_esg_data():
     """抽取ESG数据并保存为CSV文件"""
     print("🚀 ESG数据抽取脚本")
@@ -40,15 +79,25 @@ def extract_esg_data():
         dim_field = pd.read_sql("SELECT field_code, field_name, esg_bucket FROM dbo.dim_field ORDER BY field_code", cn)
         print(f"   ✅ 字段维度表: {len(dim_field)} 条记录")
         
-        # 4. 抽取事实表数据
+        # 4. 抽取事实表数据（逐批直接写出CSV，不在内存中合并全部批次）
         print("📊 抽取事实表数据...")
+        output_dir = "esg_data_export"
         
-        # 分批抽取，避免内存问题
-        batch_size = 10000
-        all_facts = []
+        def make_bge_text(df):
+            """生成BGE embedding用的文本和ID（列级字符串拼接）"""
+            # 经 object 再 map(str)：category 列可直接拼接，缺失值与逐行 f-string 一样显示为 str(值)
+            text = lambda col: df[col].astype(object).map(str)
+            ticker, field_code = text('ticker'), text('field_code')
+            year = df['year'].astype(int).astype(str)
+            bge_text = ("Company: " + text('company_name') + " (Ticker: " + ticker + ") in " + year + ": "
+                        + text('field_name') + " (Code: " + field_code + ") = " + text('val'))
+            return bge_text, ticker + "_" + year + "_" + field_code
+        
+        # 分批抽取（keyset分页：按主键顺序从上一批最后一行之后继续，避免OFFSET反复扫描跳过）
+        batch_size = 100000
         
         sql_facts = """
-        SELECT 
+        SELECT TOP (?)
             f.ticker, 
             f.[year], 
             f.field_code,
@@ -61,56 +110,73 @@ def extract_esg_data():
         FROM dbo.fact_observation f
         JOIN dbo.dim_field d ON d.field_code = f.field_code
         JOIN dbo.dim_company c ON c.ticker = f.ticker
-        WHERE (f.value_numeric IS NOT NULL OR f.value_text IS NOT NULL)
-        ORDER BY f.ticker, f.[year], d.field_code
+        WHERE (f.value_numeric IS NOT NULL OR f.value_text IS NOT NULL) {after_key}
+        ORDER BY f.ticker, f.[year], f.field_code
         """
+        # (ticker, year, field_code) > 上一批最后一行，逐列比较以与 ORDER BY 一致
+        after_key_sql = """
+          AND (f.ticker > ? OR (f.ticker = ? AND (f.[year] > ? OR (f.[year] = ? AND f.field_code > ?))))"""
         
         print("   📥 开始分批抽取事实数据...")
-        offset = 0
-        
-        while True:
-            sql_batch = f"""
-            {sql_facts}
-            OFFSET {offset} ROWS
-            FETCH NEXT {batch_size} ROWS ONLY
-            """
-            
-            batch_df = pd.read_sql(sql_batch, cn)
-            
-            if batch_df.empty:
-                break
+        extracted = 0
+        last_key = None
+        year_min = year_max = None
+        
+        with ExitStack() as files:
+            fact_file = bge_file = None
+            while True:
+                if last_key is None:
+                    sql_batch = sql_facts.format(after_key="")
+                    params = [batch_size]
+                else:
+                    ticker, year, field_code = last_key
+                    sql_batch = sql_facts.format(after_key=after_key_sql)
+                    params = [batch_size, ticker, ticker, year, year, field_code]
+                
+                batch_df = read_fact_batch(sql_batch, cn, params)
+                
+                if batch_df.empty:
+                    break
+                batch_df = batch_df.astype(FACT_DTYPES)
+                
+                # 5. 第一批数据到达时创建输出目录并打开CSV文件
+                if fact_file is None:
+                    os.makedirs(output_dir, exist_ok=True)
+                    print(f"📁 创建输出目录: {output_dir}")
+                    fact_file = files.enter_context(
+                        open(os.path.join(output_dir, "fact_observation.csv"), 'w', newline='', encoding='utf-8-sig'))
+                    bge_file = files.enter_context(
+                        open(os.path.join(output_dir, "bge_embedding_data.csv"), 'w', newline='', encoding='utf-8-sig'))
+                
+                # 6. 保存事实表批次；生成并保存BGE embedding文本批次
+                header = extracted == 0
+                batch_df.to_csv(fact_file, index=False, header=header)
+                batch_df['bge_text'], batch_df['id'] = make_bge_text(batch_df)
+                batch_df[['id', 'bge_text', 'ticker', 'company_name', 'year', 'field_code', 'field_name', 'val', 'esg_bucket']] \
+                    .to_csv(bge_file, index=False, header=header)
+                
+                extracted += len(batch_df)
+                batch_min, batch_max = batch_df['year'].min(), batch_df['year'].max()
+                year_min = batch_min if year_min is None else min(year_min, batch_min)
+                year_max = batch_max if year_max is None else max(year_max, batch_max)
+                last = batch_df.iloc[-1]
+                last_key = (last.ticker, int(last.year), last.field_code)
                 
-            all_facts.append(batch_df)
-            offset += batch_size
-            
-            print(f"   📊 已抽取 {offset} 条记录...")
-            
-            if len(batch_df) < batch_size:
-                break
-        
-        # 合并所有批次
-        if all_facts:
-            facts = pd.concat(all_facts, ignore_index=True)
-            print(f"   ✅ 事实表数据: {len(facts)} 条记录")
-        else:
+                print(f"   📊 已抽取 {extracted} 条记录...")
+                
+                if len(batch_df) < batch_size:
+                    break
+        
+        if not extracted:
             print("   ❌ 没有抽取到事实数据")
             return
-        
-        # 5. 创建输出目录
-        output_dir = "esg_data_export"
-        os.makedirs(output_dir, exist_ok=True)
-        print(f"📁 创建输出目录: {output_dir}")
-        
-        # 6. 保存数据到CSV文件
-        print("💾 保存数据到CSV文件...")
+        print(f"   ✅ 事实表数据: {extracted} 条记录")
+        print(f"✅ BGE文本数据: {extracted} 条记录")
         
         # 保存维度表
         dim_company.to_csv(os.path.join(output_dir, "dim_company.csv"), index=False, encoding='utf-8-sig')
         dim_field.to_csv(os.path.join(output_dir, "dim_field.csv"), index=False, encoding='utf-8-sig')
         
-        # 保存事实表
-        facts.to_csv(os.path.join(output_dir, "fact_observation.csv"), index=False, encoding='utf-8-sig')
-        
         # 7. 生成数据摘要
         print("📋 生成数据摘要...")
         
@@ -118,8 +184,8 @@ def extract_esg_data():
             "extraction_time": datetime.now().isoformat(),
             "total_companies": len(dim_company),
             "total_fields": len(dim_field),
-            "total_facts": len(facts),
-            "year_range": f"{facts['year'].min()}-{facts['year'].max()}",
+            "total_facts": extracted,
+            "year_range": f"{year_min}-{year_max}",
             "companies_sample": dim_company['ticker'].head(10).tolist(),
             "fields_sample": dim_field['field_code'].head(10).tolist()
         }
@@ -129,22 +195,6 @@ def extract_esg_data():
         with open(os.path.join(output_dir, "data_summary.json"), 'w', encoding='utf-8') as f:
             json.dump(summary, f, ensure_ascii=False, indent=2)
         
-        # 8. 生成用于BGE embedding的文本数据
-        print("📝 生成BGE embedding文本数据...")
-        
-        def make_bge_text(r):
-            """生成BGE embedding用的文本"""
-            return f"Company: {r.company_name} (Ticker: {r.ticker}) in {int(r.year)}: {r.field_name} (Code: {r.field_code}) = {r.val}"
-        
-        facts['bge_text'] = facts.apply(make_bge_text, axis=1)
-        facts['id'] = facts.apply(lambda r: f"{r.ticker}_{int(r.year)}_{r.field_code}", axis=1)
-        
-        # 保存BGE文本数据
-        bge_data = facts[['id', 'bge_text', 'ticker', 'company_name', 'year', 'field_code', 'field_name', 'value', 'esg_bucket']].copy()
-        bge_data.to_csv(os.path.join(output_dir, "bge_embedding_data.csv"), index=False, encoding='utf-8-sig')
-        
-        print(f"✅ BGE文本数据: {len(bge_data)} 条记录")
-        
         # 9. 输出完成信息
         print(f"\n🎉 数据抽取完成！")
         print("=" * 50)
@@ -152,15 +202,15 @@ def extract_esg_data():
         print(f"📊 文件列表:")
         print(f"   - dim_company.csv ({len(dim_company)} 条)")
         print(f"   - dim_field.csv ({len(dim_field)} 条)")
-        print(f"   - fact_observation.csv ({len(facts)} 条)")
-        print(f"   - bge_embedding_data.csv ({len(bge_data)} 条)")
+        print(f"   - fact_observation.csv ({extracted} 条)")
+        print(f"   - bge_embedding_data.csv ({extracted} 条)")
         print(f"   - data_summary.json")
         
         print(f"\n📋 数据摘要:")
         print(f"   - 公司数量: {len(dim_company)}")
         print(f"   - 字段数量: {len(dim_field)}")
-        print(f"   - 事实记录: {len(facts)}")
-        print(f"   - 年份范围: {facts['year'].min()}-{facts['year'].max()}")
+        print(f"   - 事实记录: {extracted}")
+        print(f"   - 年份范围: {year_min}-{year_max}")
         
         print(f"\n💡 下一步:")
         print(f"1. 将 {output_dir} 文件夹复制到目标电脑")
@@ -185,10 +235,21 @@ def generate_bge_build_script(output_dir):
 """
 
 import os
+import functools
 import pandas as pd
+import torch
 import chromadb
 from sentence_transformers import SentenceTransformer
 
+@functools.lru_cache(maxsize=1)
+def get_model(name):
+    """加载一次模型（有GPU时用CUDA + FP16），重复调用直接复用"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer(name, device=device)
+    if device == "cuda":
+        model.half()
+    return model.eval()
+
 def build_bge_from_csv():
     print("🚀 从CSV文件构建BGE-M3数据库")
     print("=" * 50)
@@ -197,7 +258,7 @@ def build_bge_from_csv():
         # 1. 加载BGE-M3模型
         print("📥 加载BGE-M3模型...")
         MODEL_NAME = "BAAI/bge-m3"
-        model = SentenceTransformer(MODEL_NAME)
+        model = get_model(MODEL_NAME)
         print("✅ BGE-M3模型加载完成")
         
         # 2. 读取CSV数据
@@ -214,7 +275,8 @@ def build_bge_from_csv():
         # 3. 生成embedding
         print("🔬 生成BGE-M3 embedding...")
         texts = df['bge_text'].tolist()
-        embs = model.encode(texts, normalize_embeddings=True, show_progress_bar=True)
+        with torch.inference_mode():
+            embs = model.encode(texts, normalize_embeddings=True, show_progress_bar=True).astype("float32")
         print(f"✅ 生成 {len(embs)} 个embedding")
         
         # 4. 创建Chroma数据库
@@ -240,17 +302,17 @@ def build_bge_from_csv():
         
         # 5. 添加数据
         print("💾 添加数据到Chroma...")
-        metadatas = []
-        for _, row in df.iterrows():
-            metadatas.append({
-                "ticker": str(row['ticker']).strip(),
-                "company": row['company_name'],
-                "year": int(row['year']),
-                "bucket": row['esg_bucket'] or "",
-                "field_code": row['field_code'],
-                "field_name": row['field_name'],
-                "value": row['value']
-            })
+        columns = (df[c].tolist() for c in ('ticker', 'company_name', 'year', 'esg_bucket',
+                                            'field_code', 'field_name', 'val'))
+        metadatas = [{
+            "ticker": str(ticker).strip(),
+            "company": company_name,
+            "year": int(year),
+            "bucket": esg_bucket or "",
+            "field_code": field_code,
+            "field_name": field_name,
+            "value": val
+        } for ticker, company_name, year, esg_bucket, field_code, field_name, val in zip(*columns)]
         
         collection.add(
             ids=df['id'].tolist(),
@@ -264,7 +326,8 @@ def build_bge_from_csv():
         # 6. 测试查询
         print("🧪 测试查询...")
         test_query = "A US Equity 2015年女性员工比例"
-        query_embedding = model.encode([test_query])[0].tolist()
+        with torch.inference_mode():
+            query_embedding = model.encode([test_query])[0].astype("float32").tolist()
         
         results = collection.query(
             query_embeddings=[query_embedding],
@@ -1,4 +1,5 @@
 ﻿import os, math, pandas as pd, pyodbc
+from concurrent.futures import ProcessPoolExecutor
 
 BASE_DIR = r"C:\Users\HKUBS\Desktop\database"
 SERVER   = r"localhost"
@@ -16,7 +17,8 @@ def conn(db):
 def init_db():
     cn = conn("master")
     cur = cn.cursor()
-    cur.execute("IF DB_ID('ESG') IS NULL CREATE DATABASE ESG;")
+    # 新建库使用 SIMPLE 恢复模式，使首次批量导入可以最小日志
+    cur.execute("IF DB_ID('ESG') IS NULL BEGIN CREATE DATABASE ESG; ALTER DATABASE ESG SET RECOVERY SIMPLE; END")
     cur.commit(); cn.close()
 
     cn = conn(DB); cur = cn.cursor()
@@ -50,20 +52,34 @@ def init_db():
       FOREIGN KEY (ticker) REFERENCES dbo.dim_company(ticker);""")
     cur.commit(); cn.close()
 
+MISSING_MARKS = ("","-","NA","N/A","None")
+
+def to_f(s):
+    try: return float(s)
+    except ValueError: return math.nan
+
 def read_book(path):
-    fdesc = pd.read_excel(path, sheet_name="Field Descriptions", engine="openpyxl")
+    # 工作簿只打开一次（openpyxl 只读模式），两个工作表都从同一个句柄解析
+    with pd.ExcelFile(path, engine="openpyxl") as book:
+        fdesc = book.parse("Field Descriptions")
+        df = book.parse("Data")
     fdesc.columns = [str(c).strip() for c in fdesc.columns]
     fields = fdesc[[fdesc.columns[0], fdesc.columns[1]]].dropna()
     fields = fields.rename(columns={fdesc.columns[0]:"field_code", fdesc.columns[1]:"field_name"})
     base = os.path.basename(path).lower()
     fields["esg_bucket"] = "ES" if "_es_" in base else ("G" if "_g_" in base else None)
 
-    df = pd.read_excel(path, sheet_name="Data", engine="openpyxl")
     df.columns = [str(c).strip() for c in df.columns]
-    inc = [c for c in df.columns if c.lower().startswith("incomplete")][0]
-    tic = [c for c in df.columns if c.lower().startswith("ticker")][0]
-    co  = [c for c in df.columns if "company" in c.lower()][0]
-    yr  = [c for c in df.columns if c.lower()=="year"][0]
+    # 一次遍历定位关键列（各取第一个匹配的列，判断相互独立）
+    inc = tic = co = yr = None
+    for c in df.columns:
+        l = c.lower()
+        if inc is None and l.startswith("incomplete"): inc = c
+        if tic is None and l.startswith("ticker"): tic = c
+        if co is None and "company" in l: co = c
+        if yr is None and l == "year": yr = c
+    if None in (inc, tic, co, yr):
+        raise ValueError(f"{os.path.basename(path)}: Data sheet is missing an incomplete/ticker/company/year column")
     metrics = [c for c in df.columns if c not in {inc,tic,co,yr}]
 
     long = df.melt(id_vars=[inc,tic,co,yr], value_vars=metrics,
@@ -72,14 +88,18 @@ def read_book(path):
     long["incomplete"] = long["incomplete"].astype(str).str.upper().eq("TRUE")
     long["field_code"] = long["field_code"].astype(str).str.strip()
 
-    def to_f(x):
-        s = str(x).strip()
-        if s in ("","-","NA","N/A","None"): return math.nan
-        try: return float(s)
-        except: return math.nan
-    long["value_numeric"] = long["value_raw"].apply(to_f)
-    long["value_text"] = [None if pd.notna(n) else (None if str(r).strip() in ("","-") else str(r).strip())
-                          for r,n in zip(long["value_raw"], long["value_numeric"])]
+    # 数值/文本拆分（列级向量化）：先统一转成去空白字符串，缺失标记不参与数值解析
+    raw = long["value_raw"].map(str).str.strip()
+    candidates = raw.mask(raw.isin(MISSING_MARKS))
+    numeric = pd.to_numeric(candidates, errors="coerce").astype(float)
+    # to_numeric 不认的写法（全角数字、下划线分隔等）只对剩余的少量文本单元格用 float() 兜底；
+    # 空单元格（"nan"）无论如何都是 NaN，不必重试
+    retry = numeric.isna() & candidates.notna() & (raw.str.lower() != "nan")
+    if retry.any():
+        numeric[retry] = candidates[retry].map(to_f)
+    long["value_numeric"] = numeric
+    is_text = long["value_numeric"].isna() & ~raw.isin(("","-"))
+    long["value_text"] = raw.astype(object).where(is_text, None)
     long["source_file"] = os.path.basename(path)
     long = long[(~long["value_numeric"].isna()) | (long["value_text"].notna())]
 
@@ -87,20 +107,43 @@ def read_book(path):
     fact = long[["ticker","year","field_code","value_numeric","value_text","incomplete","source_file"]]
     return fields.drop_duplicates("field_code"), dim_company, fact
 
+STAGE_BATCH = 10000
+
 def upsert(conn, table, cols, keys, rows):
+    """Bulk-load rows into a staging table, then MERGE (or TABLOCK-insert into an empty table)"""
     if not rows: return 0
     cur = conn.cursor(); cur.fast_executemany = True
+    stg = "##stg_" + table.split(".")[-1]
     cols_br = ", ".join(f"[{c}]" for c in cols)
     params  = ", ".join("?" for _ in cols)
+    keys_br = ", ".join(f"[{k}]" for k in keys)
     on   = " AND ".join(f"t.[{k}]=s.[{k}]" for k in keys)
     setc = ", ".join(f"t.[{c}]=s.[{c}]" for c in cols if c not in keys)
-    sql = f"""MERGE {table} AS t
-USING (VALUES ({params})) AS s({cols_br})
+
+    # 复制目标表列类型建临时表；_seq 记录写入顺序，同键多行时以最后一行为准
+    cur.execute(f"IF OBJECT_ID('tempdb..{stg}') IS NOT NULL DROP TABLE {stg};")
+    cur.execute(f"SELECT TOP 0 {cols_br} INTO {stg} FROM {table};")
+    cur.execute(f"ALTER TABLE {stg} ADD [_seq] int IDENTITY(1,1) NOT NULL;")
+    insert = f"INSERT INTO {stg} ({cols_br}) VALUES ({params})"
+    for i in range(0, len(rows), STAGE_BATCH):
+        cur.executemany(insert, rows[i:i+STAGE_BATCH])
+    conn.commit()
+
+    source = f"""SELECT {cols_br} FROM (
+         SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys_br} ORDER BY [_seq] DESC) AS _rn FROM {stg}
+       ) d WHERE d._rn = 1"""
+    cur.execute(f"SELECT TOP 1 1 FROM {table};")
+    if cur.fetchone() is None:
+        # 首次导入（目标表为空）：TABLOCK 整表插入，可走最小日志，无需 MERGE
+        cur.execute(f"INSERT INTO {table} WITH (TABLOCK) ({cols_br})\n{source};")
+    else:
+        cur.execute(f"""MERGE {table} WITH (TABLOCK, HOLDLOCK) AS t
+USING ({source}) AS s
 ON {on}
 WHEN MATCHED THEN UPDATE SET {setc}
-WHEN NOT MATCHED THEN INSERT ({cols_br}) VALUES ({cols_br});"""
-    for i in range(0, len(rows), 20):
-        cur.executemany(sql, rows[i:i+800]); conn.commit()
+WHEN NOT MATCHED THEN INSERT ({cols_br}) VALUES ({cols_br});""")
+    cur.execute(f"DROP TABLE {stg};")
+    conn.commit()
     return len(rows)
 
 def main():
@@ -108,10 +151,13 @@ def main():
     conn_esg = conn(DB)
     paths = [os.path.join(BASE_DIR, f) for f in os.listdir(BASE_DIR)
              if f.lower().endswith((".xlsx",".xls",".xlsm")) and f.lower().startswith("combined_")]
-    all_f, all_c, all_x = [], [], []
-    for p in sorted(paths):
-        f, c, x = read_book(p)
-        all_f.append(f); all_c.append(c); all_x.append(x)
+    # 各工作簿相互独立，openpyxl 解析是 CPU 密集型，按文件多进程并行读取（map 保持原有顺序）
+    workers = max(1, min(len(paths), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        books = list(ex.map(read_book, sorted(paths)))
+    all_f = [f for f, _, _ in books]
+    all_c = [c for _, c, _ in books]
+    all_x = [x for _, _, x in books]
     fields = pd.concat(all_f, ignore_index=True).drop_duplicates("field_code").fillna("")
     comps  = pd.concat(all_c, ignore_index=True).drop_duplicates("ticker").fillna("")
     facts  = pd.concat(all_x, ignore_index=True)
@@ -120,12 +166,15 @@ def main():
                 fields[["field_code","field_name","esg_bucket"]].values.tolist())
     n2 = upsert(conn_esg, "dbo.dim_company", ["ticker","company_name"], ["ticker"],
                 comps[["ticker","company_name"]].values.tolist())
-    rows = []
-    for r in facts.itertuples(index=False):
-        rows.append((r.ticker, int(r.year), r.field_code,
-                     None if pd.isna(r.value_numeric) else float(r.value_numeric),
-                     r.value_text if r.value_text is not None else None,
-                     1 if bool(r.incomplete) else 0, r.source_file))
+    # 列级转换（NaN -> None，year/incomplete -> int），再按行取元组
+    facts = facts.assign(
+        year=facts["year"].astype(int),
+        value_numeric=facts["value_numeric"].astype(object).where(facts["value_numeric"].notna(), None),
+        value_text=facts["value_text"].astype(object).where(facts["value_text"].notna(), None),
+        incomplete=facts["incomplete"].astype(bool).astype(int),
+    )
+    rows = list(facts[["ticker","year","field_code","value_numeric","value_text","incomplete","source_file"]]
+                .itertuples(index=False, name=None))
     n3 = upsert(conn_esg, "dbo.fact_observation",
                 ["ticker","year","field_code","value_numeric","value_text","incomplete","source_file"],
                 ["ticker","year","field_code"], rows)
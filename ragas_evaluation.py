@@ -6,8 +6,17 @@ Reference: https://docs.ragas.io/en/stable/getstarted/rag_eval/
 
 import pandas as pd
 import numpy as np
-from typing import List, Dict
+from typing import List, Dict, Callable, Optional, Iterable, Iterator
+import os
+import re
 import json
+import asyncio
+import time
+import hashlib
+import operator
+import functools
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 try:
@@ -19,109 +28,682 @@ try:
 except ImportError:
     RAGAS_AVAILABLE = False
 
+try:
+    from langchain_openai import ChatOpenAI
+    LANGCHAIN_OPENAI_AVAILABLE = True
+except ImportError:
+    LANGCHAIN_OPENAI_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import diskcache
+    DISKCACHE_AVAILABLE = True
+except ImportError:
+    DISKCACHE_AVAILABLE = False
+
+def _json_default(obj):
+    """json/orjson 无法直接序列化的对象（datetime、NumPy、RAGAS结果等）"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+def _dumps_results(results) -> bytes:
+    """序列化评估结果为带缩进的UTF-8 JSON（orjson优先）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(results, default=_json_default,
+                            option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(results, ensure_ascii=False, indent=2, default=_json_default).encode('utf-8')
+
+def _encode_for(filename: str, data: bytes) -> bytes:
+    """.zst 文件用zstd压缩（level 3，多线程）"""
+    if not filename.endswith('.zst'):
+        return data
+    if not ZSTD_AVAILABLE:
+        raise ImportError("zstandard is required for .zst files. Install with: pip install zstandard")
+    return zstandard.ZstdCompressor(level=3, threads=-1).compress(data)
+
+def _results_filename(filename: Optional[str], compress: bool) -> str:
+    if filename is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        filename = f"ragas_evaluation_{timestamp}.json"
+    if compress and not filename.endswith('.zst'):
+        filename += '.zst'
+    return filename
+
+def load_evaluation_results(filename: str):
+    """读取保存的评估结果（按 .zst 后缀自动解压）"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if filename.endswith('.zst'):
+        if not ZSTD_AVAILABLE:
+            raise ImportError("zstandard is required for .zst files. Install with: pip install zstandard")
+        data = zstandard.ZstdDecompressor().decompress(data)
+    return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+
+def _dumps_line(record) -> bytes:
+    """序列化单条记录为一行NDJSON"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(record, default=_json_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(record, ensure_ascii=False, default=_json_default).encode('utf-8') + b"\n"
+
+# 评估记录的字段（按列保存时的列顺序）
+_RECORD_COLUMNS = ('question', 'ground_truth', 'answer', 'contexts', 'retrieved_docs', 'error', 'started_ns',
+                   'elapsed_ns')
+
+# process_query 结果中记录需要的字段
+_extract_result = operator.itemgetter('answer', 'contexts', 'retrieved_docs')
+
+def _dedupe(items: Iterable) -> list:
+    """按内容去重并保持顺序（dict等元素按其JSON内容的摘要比较）"""
+    seen = set()
+    unique = []
+    for item in items:
+        if isinstance(item, str):
+            key = item
+        else:
+            key = hashlib.blake2b(
+                json.dumps(item, sort_keys=True, default=_json_default).encode('utf-8'), digest_size=16
+            ).digest()
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+    return unique
+
+def _in_event_loop() -> bool:
+    """当前线程是否已在运行事件循环（此时不能再 asyncio.run，改为顺序执行）"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def _evaluation_run(method):
+    """评估入口：最外层调用时记录本次评估的起点，嵌套调用共用同一起点"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._run_depth == 0:
+            self._begin_run()
+        self._run_depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._run_depth -= 1
+    return wrapper
+
+# 并发执行查询的上限
+MAX_CONCURRENT_QUERIES = 8
+
+# process_query 结果磁盘缓存（需要 diskcache，默认关闭）
+QUERY_CACHE_DIR = '.eval_cache'
+QUERY_CACHE_TTL = 7 * 24 * 3600
+
+# 语义缓存：问题向量余弦相似度达到阈值时复用结果（默认关闭）
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# RAGAS官方指标使用的评审模型（复用同一个LLM包装器）
+RAGAS_JUDGE_MODEL = 'gpt-4o-mini'
+RAGAS_JUDGE_TIMEOUT = 30
+RAGAS_JUDGE_MAX_RETRIES = 2
+
+# 本地句子重合度打分：Jaccard 超过阈值即视为该句被覆盖
+SENTENCE_MATCH_THRESHOLD = 0.3
+
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+_WORD = re.compile(r'\w+')
+
+# 合并评审：每个样本只调用一次评审LLM，返回四项分数
+JUDGE_METRICS = ('faithfulness', 'answer_relevancy', 'context_precision', 'context_recall')
+
+JUDGE_PROMPT = """You are evaluating a retrieval-augmented answer. Score each metric from 0.0 to 1.0.
+
+Question: {user_input}
+
+Retrieved contexts:
+{contexts}
+
+Response: {response}
+
+Reference answer: {reference}
+
+Metrics:
+- faithfulness: claims in the response are supported by the retrieved contexts
+- answer_relevancy: the response addresses the question
+- context_precision: the retrieved contexts are relevant to the question
+- context_recall: the retrieved contexts cover the reference answer
+
+Return only a JSON object: {{"faithfulness": 0.0, "answer_relevancy": 0.0, "context_precision": 0.0, "context_recall": 0.0}}"""
+
+# ESG测试问题（只读）
+_TEST_QUESTIONS = tuple(MappingProxyType(item) for item in (
+    {
+        "question": "What were Alcoa Corp's nitrogen oxide emissions in 2007?",
+        "ground_truth": "Alcoa Corp reported nitrogen oxide emissions of 32.8 kilotons in 2007.",
+        "contexts": ("Alcoa Corp 2007 NOx emissions data",)
+    },
+    {
+        "question": "Tell me about Alcoa Corp's carbon dioxide emissions performance in 2010",
+        "ground_truth": "Alcoa Corp's carbon dioxide emissions in 2010 were 29.5 units, showing a 13.5% increase from 2009.",
+        "contexts": ("Alcoa Corp 2010 CO2 emissions data",)
+    },
+    {
+        "question": "How did Agilent Technologies Inc perform in women workforce percentage in 2015?",
+        "ground_truth": "Agilent Technologies Inc had specific women workforce percentage data for 2015.",
+        "contexts": ("Agilent Technologies Inc 2015 workforce data",)
+    },
+    {
+        "question": "What is the trend of environmental emissions for industrial companies?",
+        "ground_truth": "Environmental emissions trends vary by company and year, with some companies showing reduction efforts.",
+        "contexts": ("Environmental emissions trend data",)
+    },
+    {
+        "question": "Compare Alcoa Corp emissions between 2007 and 2010",
+        "ground_truth": "Alcoa Corp's emissions changed between 2007 and 2010, with specific values for each year.",
+        "contexts": ("Alcoa Corp emissions comparison data",)
+    }
+))
+
+def split_sentences(text: str) -> List[str]:
+    """按句末标点分句"""
+    return _SENT_SPLIT.split(text)
+
+def _hash_sentences(texts: Iterable[str]) -> tuple:
+    """分句并把每句的词集合哈希为排序后的int32（CSR：tokens + offsets）"""
+    tokens, offsets = [], [0]
+    for text in texts:
+        for sentence in split_sentences(str(text)):
+            words = {hash(w) & 0x7fffffff for w in _WORD.findall(sentence.lower())}
+            if words:
+                tokens.extend(sorted(words))
+                offsets.append(len(tokens))
+    return np.array(tokens, dtype=np.int32), np.array(offsets, dtype=np.int64)
+
+def _matched_fraction(src_tokens: np.ndarray, src_offsets: np.ndarray,
+                      ref_tokens: np.ndarray, ref_offsets: np.ndarray, threshold: float) -> float:
+    """src中与ref任一句Jaccard超过阈值的句子比例（src为空时返回NaN）"""
+    n_src = src_offsets.shape[0] - 1
+    if n_src == 0:
+        return np.nan
+    n_ref = ref_offsets.shape[0] - 1
+    
+    matched = 0
+    for i in range(n_src):
+        a0, a1 = src_offsets[i], src_offsets[i + 1]
+        for j in range(n_ref):
+            b0, b1 = ref_offsets[j], ref_offsets[j + 1]
+            # 两个有序词集合归并求交集
+            p, q, inter = a0, b0, 0
+            while p < a1 and q < b1:
+                if src_tokens[p] == ref_tokens[q]:
+                    inter += 1
+                    p += 1
+                    q += 1
+                elif src_tokens[p] < ref_tokens[q]:
+                    p += 1
+                else:
+                    q += 1
+            union = (a1 - a0) + (b1 - b0) - inter
+            if inter > threshold * union:
+                matched += 1
+                break
+    return matched / n_src
+
+if NUMBA_AVAILABLE:
+    # 只处理整数数组；分句和哈希在Python中完成
+    _matched_fraction = njit(_matched_fraction)
+
+def overlap_scores(record: Dict, threshold: float = SENTENCE_MATCH_THRESHOLD) -> tuple:
+    """
+    基于句子重合度的本地指标（无需LLM）
+    
+    context_recall = 被检索上下文覆盖的参考答案句子比例
+    faithfulness = 能在检索上下文中找到依据的回答句子比例
+    """
+    ctx_tokens, ctx_offsets = _hash_sentences(record.get('contexts') or ())
+    gt_tokens, gt_offsets = _hash_sentences([record.get('ground_truth') or ''])
+    ans_tokens, ans_offsets = _hash_sentences([record.get('answer') or ''])
+    context_recall = _matched_fraction(gt_tokens, gt_offsets, ctx_tokens, ctx_offsets, threshold)
+    faithfulness = _matched_fraction(ans_tokens, ans_offsets, ctx_tokens, ctx_offsets, threshold)
+    return context_recall, faithfulness
+
+class RAGASExtractor:
+    """构建合并评审prompt"""
+    
+    def build_prompt(self, sample: Dict) -> str:
+        contexts = "\n".join(f"[{i}] {c}" for i, c in enumerate(sample['retrieved_contexts'], 1)) or "(none)"
+        return JUDGE_PROMPT.format(
+            user_input=sample['user_input'],
+            contexts=contexts,
+            response=sample['response'],
+            reference=sample['reference']
+        )
+
+class RAGASScorer:
+    """解析评审输出并汇总分数"""
+    
+    def parse(self, raw: str) -> Dict[str, Optional[float]]:
+        """截取回复中最外层的 {…} 做一次json.loads；解析失败或缺少指标时分数为None"""
+        start, end = raw.find('{'), raw.rfind('}')
+        try:
+            data = json.loads(raw[start:end + 1])
+        except ValueError:
+            return dict.fromkeys(JUDGE_METRICS)
+        scores = {}
+        for metric in JUDGE_METRICS:
+            try:
+                scores[metric] = min(max(float(data[metric]), 0.0), 1.0)
+            except (KeyError, TypeError, ValueError):
+                scores[metric] = None
+        return scores
+    
+    def aggregate(self, rows: List[Dict]) -> Dict:
+        frame = pd.DataFrame(rows, columns=list(JUDGE_METRICS), dtype='float64')
+        means = frame.mean()
+        return {
+            'metrics': {m: (None if pd.isna(v) else float(v)) for m, v in means.items()},
+            'scored_samples': int(frame.notna().all(axis=1).sum()),
+            'total_samples': len(frame)
+        }
+
+class SemanticCache:
+    """随机投影LSH语义缓存（近似重复的问题复用已有结果）"""
+    
+    def __init__(self, hash_tables: int = 8, bits: int = 16, seed: int = 0):
+        self.hash_tables = hash_tables
+        self.bits = bits
+        self.seed = seed
+        self.planes = None  # (hash_tables * bits, D)，首次写入时按向量维度生成
+        self.tables = [{} for _ in range(hash_tables)]  # 签名 -> 条目下标
+        self.vectors = []  # L2归一化向量
+        self.results = []
+    
+    def _signatures(self, vector: np.ndarray) -> List[bytes]:
+        projected = (self.planes @ vector > 0).reshape(self.hash_tables, self.bits)
+        return [row.tobytes() for row in np.packbits(projected, axis=1)]
+    
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+    
+    def get(self, vector: np.ndarray, threshold: float = SEMANTIC_CACHE_THRESHOLD) -> Optional[Dict]:
+        """返回同桶候选中相似度最高且不低于阈值的结果"""
+        if self.planes is None:
+            return None
+        vector = self._normalize(vector)
+        
+        candidates = set()
+        for table, signature in zip(self.tables, self._signatures(vector)):
+            candidates.update(table.get(signature, ()))
+        if not candidates:
+            return None
+        
+        ids = list(candidates)
+        similarities = np.stack([self.vectors[i] for i in ids]) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= threshold:
+            return self.results[ids[best]]
+        return None
+    
+    def set(self, vector: np.ndarray, result: Dict):
+        vector = self._normalize(vector)
+        if self.planes is None:
+            rng = np.random.default_rng(self.seed)
+            self.planes = rng.standard_normal((self.hash_tables * self.bits, vector.shape[0])).astype(np.float32)
+        
+        index = len(self.results)
+        self.vectors.append(vector)
+        self.results.append(result)
+        for table, signature in zip(self.tables, self._signatures(vector)):
+            table.setdefault(signature, []).append(index)
+
+class _SummaryAccumulator:
+    """单次遍历累计手动评估统计（成功/错误数与句子重合度均值）"""
+    
+    def __init__(self):
+        self.total = 0
+        self.successful = 0
+        self.errors = 0
+        self.recall_sum, self.recall_count = 0.0, 0
+        self.faithfulness_sum, self.faithfulness_count = 0.0, 0
+    
+    def add(self, record: Dict):
+        self.total += 1
+        if record.get('answer', '') != '':
+            self.successful += 1
+        if 'error' in record:
+            self.errors += 1
+        recall, faithfulness = overlap_scores(record)
+        if recall == recall:  # 跳过NaN
+            self.recall_sum += recall
+            self.recall_count += 1
+        if faithfulness == faithfulness:
+            self.faithfulness_sum += faithfulness
+            self.faithfulness_count += 1
+    
+    def summary(self) -> Dict:
+        total = self.total
+        return {
+            'total_questions': total,
+            'successful_answers': self.successful,
+            'success_rate': self.successful / total if total > 0 else 0,
+            'error_count': self.errors,
+            'error_rate': self.errors / total if total > 0 else 0,
+            'context_recall_mean': self.recall_sum / self.recall_count if self.recall_count else None,
+            'faithfulness_mean': self.faithfulness_sum / self.faithfulness_count if self.faithfulness_count else None
+        }
+
 class MemoRAGEvaluator:
     """MemoRAG系统评估器"""
     
-    def __init__(self, rag_system):
+    # 评估记录模板（出错时另有 'error' 字段）
+    # started_ns: 查询开始时间相对 run_started_at 的偏移；elapsed_ns: 查询耗时
+    _EMPTY_RECORD = {'question': '', 'ground_truth': '', 'answer': '', 'contexts': (), 'retrieved_docs': (),
+                     'started_ns': 0, 'elapsed_ns': 0}
+    
+    def __init__(self, rag_system, judge_llm: Callable[[str], str] = None,
+                 max_concurrency: int = MAX_CONCURRENT_QUERIES,
+                 cache_dir: Optional[str] = None, cache_ttl: Optional[int] = QUERY_CACHE_TTL,
+                 cache_fingerprint: str = '',
+                 semantic_threshold: Optional[float] = None, ragas_llm=None):
         """
         初始化评估器
         
         Args:
             rag_system: MemoRAG系统实例
+            judge_llm: 评审LLM，输入prompt返回文本（如 LLMResponseGenerator._call_api）；
+                合并评审时在多个线程中并发调用（最多 max_concurrency 个）
+            max_concurrency: 同时执行的查询数上限（仅当 rag_system 提供 aprocess_query
+                或声明 thread_safe = True 时并发；FixedMemoRAG 等有共享状态的系统顺序执行）
+            cache_dir: process_query 结果缓存目录（如 QUERY_CACHE_DIR），None 表示不缓存
+            cache_ttl: 缓存过期秒数，None 表示不过期
+            cache_fingerprint: 系统/配置指纹（检索器、prompt、模型等），计入缓存键；配置变化时应随之改变
+            semantic_threshold: 语义缓存相似度阈值（如 SEMANTIC_CACHE_THRESHOLD），None 表示不使用；
+                命中的记录带 cached_from 字段，指明复用了哪个问题的结果
+            ragas_llm: RAGAS指标使用的LangChain聊天模型（或已包装的LLM），默认 ChatOpenAI
         """
         self.rag_system = rag_system
+        self.judge_llm = judge_llm
+        self.max_concurrency = max_concurrency
+        self.cache_ttl = cache_ttl
+        self.cache_fingerprint = cache_fingerprint
+        self._query_cache = diskcache.Cache(cache_dir) if DISKCACHE_AVAILABLE and cache_dir else None
+        self.semantic_threshold = semantic_threshold
+        self._semantic_cache = SemanticCache() if semantic_threshold is not None else None
+        self.extractor = RAGASExtractor()
+        self.scorer = RAGASScorer()
         self.evaluation_results = []
+        self.run_started_at = None  # 最近一次评估开始的墙钟时间
+        self._run_started_ns = None  # 同一时刻的 monotonic_ns 基准
+        self._run_depth = 0
+        self._ragas_llm_source = ragas_llm
+        self._ragas_llm = None
+        self._ragas_metrics = None
         
     def create_test_dataset(self) -> List[Dict]:
-        """创建ESG测试数据集"""
-        test_questions = [
-            {
-                "question": "What were Alcoa Corp's nitrogen oxide emissions in 2007?",
-                "ground_truth": "Alcoa Corp reported nitrogen oxide emissions of 32.8 kilotons in 2007.",
-                "contexts": ["Alcoa Corp 2007 NOx emissions data"]
-            },
-            {
-                "question": "Tell me about Alcoa Corp's carbon dioxide emissions performance in 2010",
-                "ground_truth": "Alcoa Corp's carbon dioxide emissions in 2010 were 29.5 units, showing a 13.5% increase from 2009.",
-                "contexts": ["Alcoa Corp 2010 CO2 emissions data"]
-            },
-            {
-                "question": "How did Agilent Technologies Inc perform in women workforce percentage in 2015?",
-                "ground_truth": "Agilent Technologies Inc had specific women workforce percentage data for 2015.",
-                "contexts": ["Agilent Technologies Inc 2015 workforce data"]
-            },
-            {
-                "question": "What is the trend of environmental emissions for industrial companies?",
-                "ground_truth": "Environmental emissions trends vary by company and year, with some companies showing reduction efforts.",
-                "contexts": ["Environmental emissions trend data"]
-            },
-            {
-                "question": "Compare Alcoa Corp emissions between 2007 and 2010",
-                "ground_truth": "Alcoa Corp's emissions changed between 2007 and 2010, with specific values for each year.",
-                "contexts": ["Alcoa Corp emissions comparison data"]
-            }
-        ]
+        """创建ESG测试数据集（返回普通dict副本，模块常量保持只读）"""
+        return [dict(item, contexts=list(item['contexts'])) for item in _TEST_QUESTIONS]
+    
+    def _begin_run(self):
+        """记录评估起点：墙钟时间用于保存的结果，monotonic_ns 基准用于记录的 started_ns"""
+        self.run_started_at = datetime.now()
+        self._run_started_ns = time.monotonic_ns()
+    
+    @_evaluation_run
+    def evaluate_single_query(self, question: str, ground_truth: str, force_refresh: bool = False) -> Dict:
+        """评估单个查询（命中缓存时不调用 process_query）"""
+        return self._evaluate_single_query(question, ground_truth, force_refresh)
+    
+    def _evaluate_single_query(self, question: str, ground_truth: str, force_refresh: bool = False) -> Dict:
+        t0 = time.monotonic_ns()
+        started_ns = t0 - self._run_started_ns
+        try:
+            result, vector, cache_info = self._lookup_cached(question, force_refresh)
+            if result is None:
+                result = self.rag_system.process_query(question)
+                self._store_cached(question, vector, result)
+            return self._result_record(question, ground_truth, result, started_ns, time.monotonic_ns() - t0,
+                                       **cache_info)
+        except Exception as e:
+            return self._error_record(question, ground_truth, e, started_ns, time.monotonic_ns() - t0)
+    
+    async def _evaluate_single_query_async(self, question: str, ground_truth: str,
+                                           force_refresh: bool = False) -> Dict:
+        """异步评估单个查询（仅在 _supports_concurrency() 时使用：优先 aprocess_query，否则放到线程中执行）"""
+        t0 = time.monotonic_ns()
+        started_ns = t0 - self._run_started_ns
+        try:
+            result, vector, cache_info = self._lookup_cached(question, force_refresh)
+            if result is None:
+                aprocess_query = getattr(self.rag_system, 'aprocess_query', None)
+                if aprocess_query is not None:
+                    result = await aprocess_query(question)
+                else:
+                    result = await asyncio.to_thread(self.rag_system.process_query, question)
+                self._store_cached(question, vector, result)
+            return self._result_record(question, ground_truth, result, started_ns, time.monotonic_ns() - t0,
+                                       **cache_info)
+        except Exception as e:
+            return self._error_record(question, ground_truth, e, started_ns, time.monotonic_ns() - t0)
+    
+    async def _evaluate_queries_async(self, test_data: List[Dict], force_refresh: bool = False) -> List[Dict]:
+        """并发评估所有查询，结果顺序与 test_data 一致"""
+        sem = asyncio.Semaphore(self.max_concurrency)
         
-        return test_questions
+        async def bounded(item):
+            async with sem:
+                return await self._evaluate_single_query_async(item['question'], item['ground_truth'], force_refresh)
+        
+        return await asyncio.gather(*(bounded(item) for item in test_data))
+    
+    @_evaluation_run
+    def evaluate_queries(self, test_data: List[Dict], force_refresh: bool = False) -> List[Dict]:
+        """评估所有查询；系统不支持并发或已在事件循环中时顺序执行"""
+        if self._supports_concurrency() and not _in_event_loop():
+            return asyncio.run(self._evaluate_queries_async(test_data, force_refresh))
+        return [self._evaluate_single_query(item['question'], item['ground_truth'], force_refresh)
+                for item in test_data]
+    
+    def _thread_safe(self) -> bool:
+        """rag_system 是否声明可在多个线程中同时调用 process_query"""
+        return bool(getattr(self.rag_system, 'thread_safe', False))
+    
+    def _supports_concurrency(self) -> bool:
+        """FixedMemoRAG 的 last_query / 查询向量缓存等共享状态不是线程安全的，默认顺序执行"""
+        return hasattr(self.rag_system, 'aprocess_query') or self._thread_safe()
+    
+    def _lookup_cached(self, question: str, force_refresh: bool = False) -> tuple:
+        """依次查精确缓存和语义缓存，返回 (结果或None, 问题向量或None, 写入记录的缓存标记)"""
+        if force_refresh:
+            return None, None, {}
+        result = self._cache_get(question)
+        if result is not None:
+            return result, None, {'cached': True}
+        vector = self._embed_question(question)
+        if vector is not None:
+            entry = self._semantic_cache.get(vector, self.semantic_threshold)
+            if entry is not None:
+                source_question, result = entry
+                return result, vector, {'cached': True, 'cached_from': source_question}
+        return None, vector, {}
     
-    def evaluate_single_query(self, question: str, ground_truth: str) -> Dict:
-        """评估单个查询"""
+    def _store_cached(self, question: str, vector: Optional[np.ndarray], result: Dict):
+        self._cache_set(question, result)
+        if vector is None:
+            vector = self._embed_question(question)
+        if vector is not None:
+            self._semantic_cache.set(vector, (question, result))
+    
+    def _embed_question(self, question: str) -> Optional[np.ndarray]:
+        """问题向量（FixedMemoRAG.encode_queries 或 rag_system.embedder）"""
+        if self._semantic_cache is None:
+            return None
         try:
-            result = self.rag_system.process_query(question)
-            
+            if hasattr(self.rag_system, 'encode_queries'):
+                return self.rag_system.encode_queries([question])[0]
+            embedder = getattr(self.rag_system, 'embedder', None)
+            if embedder is not None:
+                return np.asarray(embedder.encode([question]))[0]
+        except Exception:
+            pass
+        return None
+    
+    def _cache_key(self, question: str) -> str:
+        """系统指纹 + 问题的SHA-256（系统配置变化后不会命中旧结果）"""
+        return hashlib.sha256(f"{self.cache_fingerprint}\0{question}".encode('utf-8')).hexdigest()
+    
+    def _cache_get(self, question: str) -> Optional[Dict]:
+        if self._query_cache is None:
+            return None
+        return self._query_cache.get(self._cache_key(question))
+    
+    def _cache_set(self, question: str, result: Dict):
+        """只缓存记录需要的字段"""
+        if self._query_cache is None:
+            return
+        cached = {
+            'answer': result.get('answer', ''),
+            'contexts': result.get('contexts', []),
+            'retrieved_docs': result.get('retrieved_docs', [])
+        }
+        self._query_cache.set(self._cache_key(question), cached, expire=self.cache_ttl)
+    
+    def invalidate(self, question: str) -> bool:
+        """删除某个问题的缓存结果"""
+        if self._query_cache is None:
+            return False
+        return self._query_cache.delete(self._cache_key(question))
+    
+    def warm_cache(self, questions: Iterable[str]) -> int:
+        """预先执行未缓存的问题，返回新缓存的数量"""
+        if self._query_cache is None:
+            return 0
+        pending = [{'question': q, 'ground_truth': ''} for q in questions if self._cache_get(q) is None]
+        results = self.evaluate_queries(pending)
+        return sum('error' not in r for r in results)
+    
+    async def _aiter_query_results(self, test_data: List[Dict]):
+        """并发评估所有查询（最多 max_concurrency 个同时进行），按完成顺序产出结果"""
+        sem = asyncio.Semaphore(self.max_concurrency)
+        
+        async def bounded(item):
+            async with sem:
+                return await self._evaluate_single_query_async(item['question'], item['ground_truth'])
+        
+        tasks = [asyncio.ensure_future(bounded(item)) for item in test_data]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # 调用方提前停止迭代时取消未完成的查询
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def iter_query_results(self, test_data: List[Dict]) -> Iterator[Dict]:
+        """
+        逐条产出评估结果
+        
+        支持并发时整个流程共用一个事件循环，结果按完成顺序产出（记录中带 question）；
+        否则按 test_data 顺序逐条执行
+        """
+        if self._run_depth == 0:
+            self._begin_run()
+        if not self._supports_concurrency() or _in_event_loop():
+            for item in test_data:
+                yield self._evaluate_single_query(item['question'], item['ground_truth'])
+            return
+        
+        loop = asyncio.new_event_loop()
+        results = self._aiter_query_results(test_data)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+    
+    @classmethod
+    def _make_record(cls, **fields) -> Dict:
+        """按记录模板构建评估记录，成功和出错两条路径共用同一字段结构"""
+        # 模板中的列表字段用元组占位，每条记录各自新建列表
+        record = {key: list(value) if isinstance(value, tuple) else value
+                  for key, value in cls._EMPTY_RECORD.items()}
+        record.update(fields)
+        return record
+    
+    @classmethod
+    def _result_record(cls, question: str, ground_truth: str, result: Dict, started_ns: int, elapsed_ns: int,
+                       **extra) -> Dict:
+        try:
+            answer, contexts, retrieved_docs = _extract_result(result)
+        except KeyError:
             answer = result.get('answer', '')
             contexts = result.get('contexts', [])
             retrieved_docs = result.get('retrieved_docs', [])
-            
-            evaluation_result = {
-                'question': question,
-                'ground_truth': ground_truth,
-                'answer': answer,
-                'contexts': contexts,
-                'retrieved_docs': retrieved_docs,
-                'timestamp': datetime.now().isoformat()
-            }
-            
-            return evaluation_result
-            
-        except Exception as e:
-            return {
-                'question': question,
-                'ground_truth': ground_truth,
-                'answer': '',
-                'contexts': [],
-                'retrieved_docs': [],
-                'error': str(e),
-                'timestamp': datetime.now().isoformat()
-            }
+        
+        return cls._make_record(question=question, ground_truth=ground_truth, answer=answer,
+                                contexts=_dedupe(contexts), retrieved_docs=_dedupe(retrieved_docs),
+                                started_ns=started_ns, elapsed_ns=elapsed_ns, **extra)
+    
+    @classmethod
+    def _error_record(cls, question: str, ground_truth: str, error: Exception, started_ns: int,
+                      elapsed_ns: int) -> Dict:
+        return cls._make_record(question=question, ground_truth=ground_truth, started_ns=started_ns,
+                                elapsed_ns=elapsed_ns, error=str(error))
     
-    def run_ragas_evaluation(self, test_data: List[Dict]) -> Dict:
-        """运行RAGAS评估"""
+    @_evaluation_run
+    def run_ragas_evaluation(self, test_data: List[Dict], use_consolidated: bool = False) -> Dict:
+        """运行RAGAS评估（use_consolidated=True时使用合并评审，每样本一次LLM调用）"""
+        if use_consolidated:
+            return self.run_consolidated_evaluation(test_data)
+        
         if not RAGAS_AVAILABLE:
             return {"error": "RAGAS not available. Install with: pip install ragas"}
         
         try:
-            ragas_data = []
-            for item in test_data:
-                result = self.evaluate_single_query(item['question'], item['ground_truth'])
-                
-                ragas_item = {
-                    'user_input': item['question'],
-                    'retrieved_contexts': result['contexts'],
-                    'response': result['answer'],
-                    'reference': item['ground_truth']
-                }
-                ragas_data.append(ragas_item)
+            results = self.evaluate_queries(test_data)
+            columns = {
+                'user_input': [item['question'] for item in test_data],
+                'retrieved_contexts': [list(result['contexts']) for result in results],
+                'response': [result['answer'] for result in results],
+                'reference': [item['ground_truth'] for item in test_data]
+            }
             
-            evaluation_dataset = EvaluationDataset.from_list(ragas_data)
+            evaluation_dataset = EvaluationDataset.from_list(
+                [dict(zip(columns, row)) for row in zip(*columns.values())]
+            )
             
             result = evaluate(
                 dataset=evaluation_dataset,
-                metrics=[
-                    LLMContextRecall(),
-                    Faithfulness(), 
-                    FactualCorrectness()
-                ]
+                metrics=self._get_ragas_metrics(),
+                llm=self._get_ragas_llm()
             )
             
             return result
@@ -129,64 +711,208 @@ class MemoRAGEvaluator:
         except Exception as e:
             return {"error": f"RAGAS evaluation failed: {str(e)}"}
     
-    def manual_evaluation(self, test_data: List[Dict]) -> Dict:
-        """手动评估（当RAGAS不可用时）"""
-        results = []
-        
-        for item in test_data:
-            result = self.evaluate_single_query(item['question'], item['ground_truth'])
-            results.append(result)
-        
-        total_questions = len(results)
-        successful_answers = len([r for r in results if r.get('answer', '') != ''])
-        error_count = len([r for r in results if 'error' in r])
-        
-        evaluation_summary = {
-            'total_questions': total_questions,
-            'successful_answers': successful_answers,
-            'success_rate': successful_answers / total_questions if total_questions > 0 else 0,
-            'error_count': error_count,
-            'error_rate': error_count / total_questions if total_questions > 0 else 0,
-            'detailed_results': results
-        }
+    def _get_ragas_llm(self):
+        """懒加载并复用同一个RAGAS LLM包装器（保持连接池）"""
+        if self._ragas_llm is None:
+            llm = self._ragas_llm_source
+            if llm is None and LANGCHAIN_OPENAI_AVAILABLE:
+                llm = ChatOpenAI(model=RAGAS_JUDGE_MODEL, timeout=RAGAS_JUDGE_TIMEOUT,
+                                 max_retries=RAGAS_JUDGE_MAX_RETRIES)
+            if llm is not None and not isinstance(llm, LangchainLLMWrapper):
+                llm = LangchainLLMWrapper(llm)
+            self._ragas_llm = llm
+        return self._ragas_llm
+    
+    def _get_ragas_metrics(self) -> List:
+        """构建一次指标对象，共享同一个评审LLM"""
+        if self._ragas_metrics is None:
+            llm = self._get_ragas_llm()
+            kwargs = {'llm': llm} if llm is not None else {}
+            self._ragas_metrics = [
+                LLMContextRecall(**kwargs),
+                Faithfulness(**kwargs),
+                FactualCorrectness(**kwargs)
+            ]
+        return self._ragas_metrics
+    
+    @_evaluation_run
+    def run_consolidated_evaluation(self, test_data: List[Dict]) -> Dict:
+        """合并评审：一个prompt得到faithfulness/answer_relevancy/context_precision/context_recall"""
+        if self.judge_llm is None:
+            return {"error": "Consolidated evaluation requires a judge_llm"}
+        
+        try:
+            samples = []
+            for item, result in zip(test_data, self.evaluate_queries(test_data)):
+                samples.append({
+                    'user_input': item['question'],
+                    'retrieved_contexts': result['contexts'],
+                    'response': result['answer'],
+                    'reference': item['ground_truth']
+                })
+            
+            raws = self._judge_all([self.extractor.build_prompt(sample) for sample in samples])
+            rows = [self.scorer.parse(raw) for raw in raws]
+            
+            summary = self.scorer.aggregate(rows)
+            summary['per_sample'] = [
+                {'user_input': sample['user_input'], **scores} for sample, scores in zip(samples, rows)
+            ]
+            return summary
+            
+        except Exception as e:
+            return {"error": f"Consolidated evaluation failed: {str(e)}"}
+    
+    async def _judge_all_async(self, prompts: List[str]) -> List[str]:
+        """在线程中并发调用评审LLM（与查询共用 max_concurrency 上限），结果顺序与 prompts 一致"""
+        sem = asyncio.Semaphore(self.max_concurrency)
+        
+        async def bounded(prompt):
+            async with sem:
+                return await asyncio.to_thread(self.judge_llm, prompt)
+        
+        return await asyncio.gather(*(bounded(prompt) for prompt in prompts))
+    
+    def _judge_all(self, prompts: List[str]) -> List[str]:
+        """调用评审LLM；已在事件循环中时顺序执行"""
+        if not _in_event_loop():
+            return asyncio.run(self._judge_all_async(prompts))
+        return [self.judge_llm(prompt) for prompt in prompts]
+    
+    @_evaluation_run
+    def manual_evaluation(self, test_data: List[Dict], columnar: bool = False) -> Dict:
+        """
+        手动评估（当RAGAS不可用时）
+        
+        columnar=True 时 detailed_results 按列保存（{字段: [值, ...]}）
+        """
+        results = self.evaluate_queries(test_data)
+        
+        accumulator = _SummaryAccumulator()
+        for result in results:
+            accumulator.add(result)
+        evaluation_summary = accumulator.summary()
+        
+        if columnar:
+            frame = pd.DataFrame(results, columns=list(_RECORD_COLUMNS))
+            frame['error'] = frame['error'].astype(object).where(frame['error'].notna(), None)
+            evaluation_summary['detailed_results'] = frame.to_dict(orient='list')
+        else:
+            evaluation_summary['detailed_results'] = results
         
         return evaluation_summary
     
-    def save_evaluation_results(self, results: Dict, filename: str = None):
-        """保存评估结果"""
+    @_evaluation_run
+    def manual_evaluation_stream(self, test_data: List[Dict], filename: str) -> Dict:
+        """手动评估，逐条写入NDJSON；统计信息写入 .summary.json"""
+        accumulator = _SummaryAccumulator()
+        summary = {'run_started_at': self.run_started_at}
+        
+        def tracked():
+            for result in self.iter_query_results(test_data):
+                accumulator.add(result)
+                yield result
+            summary.update(accumulator.summary())
+        
+        self.save_evaluation_results_stream(summary, tracked(), filename)
+        return summary
+    
+    def save_evaluation_results(self, results: Dict, filename: str = None, compress: bool = False):
+        """保存评估结果（compress=True 或文件名以 .zst 结尾时用zstd压缩）"""
+        filename = self._write_results(self._with_run_info(results), filename, compress)
+        print(f"Evaluation results saved to: {filename}")
+    
+    def _with_run_info(self, results):
+        """保存的结果附带评估起始墙钟时间（记录的时间 = run_started_at + started_ns）"""
+        if self.run_started_at is None:
+            return results
+        if isinstance(results, dict):
+            return {'run_started_at': self.run_started_at, **results}
+        return {'run_started_at': self.run_started_at, 'results': results}
+    
+    @staticmethod
+    def _write_results(results: Dict, filename: str = None, compress: bool = False) -> str:
+        """序列化并写入评估结果（不打印，可在后台线程中执行），返回实际文件名"""
+        filename = _results_filename(filename, compress)
+        data = _encode_for(filename, _dumps_results(results))
+        
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+    
+    def save_evaluation_results_stream(self, summary_header: Dict, results_iter: Iterable[Dict], filename: str = None):
+        """
+        逐条保存评估结果（NDJSON，每条记录写入后立即flush）
+        
+        summary_header 在所有记录写完后才写入 <filename>.summary.json，
+        因此可由 results_iter 在迭代过程中填充统计信息
+        """
         if filename is None:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"ragas_evaluation_{timestamp}.json"
+            filename = f"ragas_evaluation_{timestamp}.jsonl"
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
+        with open(filename, 'wb') as f:
+            for record in results_iter:
+                f.write(_dumps_line(record))
+                f.flush()
         
-        print(f"Evaluation results saved to: {filename}")
+        summary_file = os.path.splitext(filename)[0] + ".summary.json"
+        with open(summary_file, 'wb') as f:
+            f.write(_dumps_results(summary_header))
+        
+        print(f"Evaluation results saved to: {filename} (summary: {summary_file})")
     
-    def run_full_evaluation(self):
-        """运行完整评估"""
+    @_evaluation_run
+    def run_full_evaluation(self, use_consolidated: bool = False, stream: bool = False):
+        """
+        运行完整评估
+        
+        use_consolidated=True 时用 judge_llm 合并评审代替官方RAGAS指标，
+        结果单独保存到 consolidated_evaluation_results.json
+        
+        stream=True 时手动评估逐条写入 manual_evaluation_results.jsonl（统计信息在 .summary.json），
+        返回值不含 detailed_results；默认保存 manual_evaluation_results.json 并返回完整结果
+        """
         print("🚀 Starting MemoRAG-Engine Evaluation...")
         
         test_data = self.create_test_dataset()
         print(f"📊 Created {len(test_data)} test questions")
         
-        if RAGAS_AVAILABLE:
-            print("🔍 Running RAGAS evaluation...")
-            ragas_results = self.run_ragas_evaluation(test_data)
+        with ThreadPoolExecutor(max_workers=1) as saver:
+            # RAGAS结果在后台写盘，同时进行手动评估
+            pending_save = None
             
-            if 'error' not in ragas_results:
-                print("✅ RAGAS evaluation completed successfully!")
-                print(f"📈 RAGAS Results: {ragas_results}")
-                self.save_evaluation_results(ragas_results, "ragas_evaluation_results.json")
+            if use_consolidated:
+                label, results_file = "Consolidated judge", "consolidated_evaluation_results.json"
             else:
-                print(f"❌ RAGAS evaluation failed: {ragas_results['error']}")
-        
-        print("🔍 Running manual evaluation...")
-        manual_results = self.manual_evaluation(test_data)
-        print("✅ Manual evaluation completed!")
-        print(f"📈 Manual Results: {manual_results}")
+                label, results_file = "RAGAS", "ragas_evaluation_results.json"
+            
+            if RAGAS_AVAILABLE or use_consolidated:
+                print(f"🔍 Running {label} evaluation...")
+                ragas_results = self.run_ragas_evaluation(test_data, use_consolidated=use_consolidated)
+                
+                if 'error' not in ragas_results:
+                    print(f"✅ {label} evaluation completed successfully!")
+                    print(f"📈 {label} Results: {ragas_results}")
+                    pending_save = saver.submit(self._write_results, self._with_run_info(ragas_results),
+                                                results_file)
+                else:
+                    print(f"❌ {label} evaluation failed: {ragas_results['error']}")
+            
+            print("🔍 Running manual evaluation...")
+            if stream:
+                manual_results = self.manual_evaluation_stream(test_data, "manual_evaluation_results.jsonl")
+            else:
+                manual_results = self.manual_evaluation(test_data)
+            print("✅ Manual evaluation completed!")
+            print(f"📈 Manual Results: {manual_results}")
+            
+            if pending_save is not None:
+                # 在主线程打印，避免与手动评估的输出交错
+                print(f"Evaluation results saved to: {pending_save.result()}")
         
-        self.save_evaluation_results(manual_results, "manual_evaluation_results.json")
+        if not stream:
+            self.save_evaluation_results(manual_results, "manual_evaluation_results.json")
         
         return manual_results
 